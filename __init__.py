@@ -8,7 +8,10 @@
 from trytond.pool import Pool
 from party import Address, PaymentProfile, Party
 from transaction import PaymentGatewayBraintree, PaymentTransactionBraintree, \
-    AddPaymentProfile, TransactionLog
+    AddPaymentProfile, TransactionLog, BraintreeCaptureQueue
+from reconciliation import BraintreeReconciliation, \
+    BraintreeReconciliationLine
+from vault_import import BraintreeVaultImport
 
 
 def register():
@@ -19,6 +22,10 @@ def register():
         PaymentTransactionBraintree,
         Party,
         TransactionLog,
+        BraintreeCaptureQueue,
+        BraintreeReconciliation,
+        BraintreeReconciliationLine,
+        BraintreeVaultImport,
         module='payment_gateway_braintree', type_='model'
     )
     Pool.register(
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    batch.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+from collections import OrderedDict
+from itertools import izip_longest
+from threading import BoundedSemaphore, Lock
+from multiprocessing.pool import ThreadPool
+
+from trytond.config import config
+
+__all__ = ['map_concurrently', 'failing', 'RateLimiter', 'BatchReport']
+
+
+def default_workers():
+    return config.getint('braintree', 'batch_workers', default=10)
+
+
+def interleave(items, key):
+    """
+    Return the indexes of `items` ordered round-robin over their keys, so
+    that a pool working through them in order spreads the load evenly.
+    """
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        groups.setdefault(key(item), []).append(index)
+    order = []
+    for batch in izip_longest(*groups.values()):
+        order.extend(index for index in batch if index is not None)
+    return order
+
+
+class RateLimiter(object):
+    """
+    Space out calls made from many threads so that at most `rate` of them
+    start per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.time()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_pool(func, items, workers):
+    """
+    Return the results of `func` called on every item by `workers` threads
+    """
+    if workers == 1:
+        return map(func, items)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_concurrently(
+    func, items, workers=None, key=None, key_limit=None, rate=None
+):
+    """
+    Call `func` on every item using a bounded pool of threads and return a
+    list of `(result, exception)` tuples in the order of `items`.
+
+    If `key` is given, at most `key_limit` calls run at the same time for
+    items sharing the same key. If `rate` is given, at most `rate` calls
+    start per second.
+
+    The calls run outside of the trytond transaction, so `func` must only
+    talk to Braintree and never touch records.
+    """
+    items = list(items)
+    if not items:
+        return []
+    workers = min(workers or default_workers(), len(items))
+
+    semaphores = {}
+    if key is not None and key_limit:
+        for item in items:
+            semaphores.setdefault(key(item), BoundedSemaphore(key_limit))
+        order = interleave(items, key)
+    else:
+        order = range(len(items))
+
+    limiter = RateLimiter(rate) if rate else None
+
+    def call(index):
+        item = items[index]
+        semaphore = semaphores.get(key(item)) if semaphores else None
+        if limiter is not None:
+            limiter.wait()
+        try:
+            if semaphore is not None:
+                with semaphore:
+                    return func(item), None
+            return func(item), None
+        except Exception as exc:
+            return None, exc
+
+    ordered = [None] * len(items)
+    for index, result in zip(order, run_pool(call, order, workers)):
+        ordered[index] = result
+    return ordered
+
+
+def failing(exc):
+    """
+    Return a callable raising `exc`, to make a record which can not be
+    processed fail like the others of a batch.
+    """
+    def fail():
+        raise exc
+    return fail
+
+
+class BatchReport(object):
+    """
+    Outcome of a batch operation: the state reached by every record plus
+    throughput figures.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.outcomes = {}
+
+    def add(self, record, outcome):
+        self.outcomes[record.id] = outcome
+
+    def stop(self):
+        self.end = time.time()
+        return self
+
+    def as_dict(self):
+        elapsed = (self.end or time.time()) - self.start
+        counts = {}
+        for outcome in self.outcomes.itervalues():
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return {
+            'outcomes': self.outcomes,
+            'counts': counts,
+            'total': len(self.outcomes),
+            'elapsed': elapsed,
+            'throughput': len(self.outcomes) / elapsed if elapsed else 0.0,
+        }
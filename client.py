@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+    client.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import random
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from braintree.util.http import Http
+from braintree.exceptions.braintree_error import BraintreeError
+from braintree.exceptions.down_for_maintenance_error import \
+    DownForMaintenanceError
+from braintree.exceptions.server_error import ServerError
+from braintree.exceptions.too_many_requests_error import TooManyRequestsError
+from braintree.exceptions.http.connection_error import ConnectionError
+from braintree.exceptions.http.invalid_response_error import \
+    InvalidResponseError
+from braintree.exceptions.http.timeout_error import TimeoutError
+
+__all__ = [
+    'PooledHttp', 'CircuitBreaker', 'GatewayUnavailableError',
+    'ExpiredCardError', 'call_with_retry', 'RETRYABLE_ERRORS',
+]
+
+# Errors after which the same call may succeed. Calls rejected by an open
+# circuit breaker are not retried.
+RETRYABLE_ERRORS = (
+    ConnectionError, TimeoutError, InvalidResponseError, ServerError,
+    DownForMaintenanceError, TooManyRequestsError,
+)
+
+
+def call_with_retry(func, attempts=3, backoff=0.5, max_backoff=8,
+                    recover=None):
+    """
+    Call `func` and return its result, calling it again after transient
+    errors. The n-th retry waits a random time between 0 and
+    `backoff * 2 ** (n - 1)` seconds, at most `max_backoff`.
+
+    A call which failed may have been processed by Braintree anyway, so
+    before every retry `recover` is called if given. If it returns a result
+    the previous call went through and that result is returned instead of
+    calling `func` again. If it fails too, it is called again at the next
+    attempt, `func` is never called again without a successful check.
+    """
+    attempt = 1
+    while True:
+        try:
+            if recover is not None and attempt > 1:
+                result = recover()
+                if result is not None:
+                    return result
+            return func()
+        except RETRYABLE_ERRORS:
+            if attempt >= attempts:
+                raise
+            time.sleep(random.uniform(
+                0, min(max_backoff, backoff * 2 ** (attempt - 1))
+            ))
+            attempt += 1
+
+
+class GatewayUnavailableError(BraintreeError):
+    """
+    Raised without calling Braintree while the circuit breaker of the
+    gateway is open.
+    """
+
+
+class ExpiredCardError(BraintreeError):
+    """
+    Raised without calling Braintree when charging a payment profile whose
+    card is known to have expired.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a gateway which keeps failing or answering slowly.
+
+    The outcome of the last `window` calls is kept. Once at least
+    `min_calls` were made, the circuit opens if the share of failed calls
+    reaches `error_rate` or the share of calls slower than `slow_call`
+    seconds reaches `slow_rate`. While open, calls fail immediately with
+    `GatewayUnavailableError`. After `reset_timeout` seconds a single probe
+    call is let through (half-open): the circuit closes if it succeeds and
+    opens again otherwise.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+        self, window=20, min_calls=10, error_rate=0.5, slow_call=10,
+        slow_rate=0.5, reset_timeout=30
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    @classmethod
+    def get(cls, key, **options):
+        """
+        Return the circuit breaker registered under `key`, creating it with
+        `options` the first time. The state of a gateway's breaker thus
+        survives its client being rebuilt.
+        """
+        with cls._registry_lock:
+            breaker = cls._registry.get(key)
+            if breaker is None:
+                breaker = cls._registry[key] = cls(**options)
+            return breaker
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and \
+                    time.time() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def _open(self):
+        # Called with the lock held
+        self._state = self.OPEN
+        self._opened_at = time.time()
+        self._probing = False
+        self._calls.clear()
+        self.trips += 1
+
+    def before_call(self):
+        """
+        Raise `GatewayUnavailableError` unless a call may be made
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and \
+                    time.time() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            raise GatewayUnavailableError(
+                'Braintree is unavailable, the circuit breaker is %s'
+                % self._state
+            )
+
+    def record(self, success, duration):
+        """
+        Record the outcome of a call allowed by `before_call`
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if success and duration < self.slow_call:
+                    self._state = self.CLOSED
+                    self._probing = False
+                else:
+                    self._open()
+                return
+            if self._state != self.CLOSED:
+                return
+
+            self._calls.append((success, duration >= self.slow_call))
+            count = len(self._calls)
+            if count < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self._calls if not ok)
+            slow = sum(1 for _, is_slow in self._calls if is_slow)
+            if failures >= self.error_rate * count or \
+                    slow >= self.slow_rate * count:
+                self._open()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+class PooledHttp(Http):
+    """
+    HTTP strategy for the braintree library that keeps connections alive in
+    a pool instead of opening a new TLS connection for every API call.
+
+    One strategy is created per gateway client. The pool is dropped when it
+    has not been used for `idle_timeout` seconds so that connections the
+    server already closed are not reused.
+
+    If a `CircuitBreaker` is given, every call goes through it. Connection
+    errors, timeouts, server errors and rate limiting count as failures.
+    """
+
+    def __init__(
+        self, config, environment=None, pool_size=10, connect_timeout=10,
+        read_timeout=60, idle_timeout=60, breaker=None
+    ):
+        super(PooledHttp, self).__init__(config, environment)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.breaker = breaker
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._last_used = None
+        self._in_flight = 0
+
+        # Counters of the sessions that have been evicted already
+        self._requests = 0
+        self._connections = 0
+        self._evictions = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, pool_block=True
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _pools(self, session):
+        # The same adapter is mounted for http and https
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    def _evict(self):
+        # Called with the lock held
+        for pool in self._pools(self._session):
+            self._requests += pool.num_requests
+            self._connections += pool.num_connections
+        self._session.close()
+        self._session = None
+        self._evictions += 1
+
+    def _acquire(self):
+        with self._lock:
+            now = time.time()
+            if self._session is not None and not self._in_flight and \
+                    now - self._last_used > self.idle_timeout:
+                self._evict()
+            if self._session is None:
+                self._session = self._new_session()
+            self._last_used = now
+            self._in_flight += 1
+            return self._session
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._last_used = time.time()
+
+    def http_do(self, http_verb, path, headers, request_body):
+        if not path.startswith(self.config.base_url()):
+            path = self.config.base_url() + path
+
+        if self.breaker is not None:
+            self.breaker.before_call()
+
+        session = self._acquire()
+        start = time.time()
+        try:
+            response = session.request(
+                http_verb, path,
+                headers=headers,
+                data=request_body,
+                verify=self.environment.ssl_certificate,
+                timeout=(self.connect_timeout, self.read_timeout),
+            )
+        except Exception:
+            if self.breaker is not None:
+                self.breaker.record(False, time.time() - start)
+            raise
+        finally:
+            self._release()
+
+        if self.breaker is not None:
+            self.breaker.record(
+                response.status_code < 500 and response.status_code != 429,
+                time.time() - start
+            )
+        return [response.status_code, response.text]
+
+    def handle_exception(self, exception):
+        # Errors raised by the strategy itself must not be wrapped
+        if isinstance(exception, BraintreeError):
+            raise exception
+        super(PooledHttp, self).handle_exception(exception)
+
+    def stats(self):
+        """
+        Return the counters of the connection pool.
+
+        A hit is a request served on a connection that was already open, a
+        miss is a request that had to open a new connection.
+        """
+        with self._lock:
+            requests_count = self._requests
+            connections = self._connections
+            if self._session is not None:
+                for pool in self._pools(self._session):
+                    requests_count += pool.num_requests
+                    connections += pool.num_connections
+            return {
+                'requests': requests_count,
+                'hits': requests_count - connections,
+                'misses': connections,
+                'evictions': self._evictions,
+                'in_flight': self._in_flight,
+                'pool_size': self.pool_size,
+                'circuit_breaker': (
+                    self.breaker.stats() if self.breaker is not None
+                    else None
+                ),
+            }
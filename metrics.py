@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import socket
+import logging
+import threading
+from bisect import bisect_left
+
+__all__ = [
+    'Metrics', 'InstrumentedClient', 'PrometheusExporter', 'StatsdExporter',
+    'metrics',
+]
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    float('inf'),
+)
+
+OUTCOMES = ('success', 'decline', 'error')
+
+
+class Metrics(object):
+    """
+    Latency histograms, outcome counters and in-flight gauges of the calls
+    made to Braintree, by database, gateway and operation.
+
+    Exporters registered with `add_exporter` are told about every call as
+    it ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._exporters = []
+
+    def _get_series(self, key):
+        # Called with the lock held
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {
+                'count': 0,
+                'sum': 0.0,
+                'buckets': [0] * len(BUCKETS),
+                'outcomes': dict.fromkeys(OUTCOMES, 0),
+                'in_flight': 0,
+            }
+        return series
+
+    def add_exporter(self, exporter):
+        with self._lock:
+            if exporter not in self._exporters:
+                self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        with self._lock:
+            if exporter in self._exporters:
+                self._exporters.remove(exporter)
+
+    def start(self, key):
+        with self._lock:
+            self._get_series(key)['in_flight'] += 1
+
+    def stop(self, key, outcome, duration):
+        with self._lock:
+            series = self._get_series(key)
+            series['in_flight'] -= 1
+            series['count'] += 1
+            series['sum'] += duration
+            series['buckets'][bisect_left(BUCKETS, duration)] += 1
+            series['outcomes'][outcome] += 1
+            exporters = list(self._exporters)
+        for exporter in exporters:
+            try:
+                exporter.observe(key, outcome, duration)
+            except Exception:
+                logger.exception('Metrics exporter %r failed', exporter)
+
+    def snapshot(self, database=None):
+        """
+        Return a copy of the readings, of a single database if given, as a
+        list of dictionaries. Histogram buckets are cumulative `(upper bound,
+        count)` pairs, the last bound being None for infinity.
+        """
+        with self._lock:
+            items = sorted(self._series.items())
+            readings = []
+            for (db_name, gateway, operation), series in items:
+                if database is not None and db_name != database:
+                    continue
+                cumulative, buckets = 0, []
+                for bound, count in zip(BUCKETS, series['buckets']):
+                    cumulative += count
+                    buckets.append((
+                        None if bound == float('inf') else bound, cumulative
+                    ))
+                readings.append({
+                    'database': db_name,
+                    'gateway': gateway,
+                    'operation': operation,
+                    'count': series['count'],
+                    'sum': series['sum'],
+                    'buckets': buckets,
+                    'outcomes': dict(series['outcomes']),
+                    'in_flight': series['in_flight'],
+                })
+            return readings
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+metrics = Metrics()
+
+
+class _InstrumentedGateway(object):
+    """
+    Proxy of one of the gateways of a client (`transaction`, `customer`...)
+    timing the calls of its methods.
+    """
+
+    def __init__(self, gateway, name, labels, registry):
+        self._gateway = gateway
+        self._name = name
+        self._labels = labels
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attr = getattr(self._gateway, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        key = self._labels + ('%s.%s' % (self._name, name),)
+        registry = self._registry
+
+        def call(*args, **kwargs):
+            registry.start(key)
+            start = time.time()
+            outcome = 'error'
+            try:
+                result = attr(*args, **kwargs)
+                if getattr(result, 'is_success', True):
+                    outcome = 'success'
+                else:
+                    outcome = 'decline'
+                return result
+            finally:
+                registry.stop(key, outcome, time.time() - start)
+        return call
+
+
+class InstrumentedClient(object):
+    """
+    Wrap a `braintree.BraintreeGateway` so that every API call is recorded
+    in `registry` under `labels` (database and gateway) and the name of the
+    operation, like `transaction.sale`.
+
+    Calls returning an unsuccessful result count as declines, calls raising
+    an exception as errors.
+    """
+    INSTRUMENTED = (
+        'transaction', 'customer', 'credit_card', 'payment_method',
+        'verification', 'address', 'subscription',
+    )
+
+    def __init__(self, client, labels, registry=metrics):
+        self._client = client
+        for name in self.INSTRUMENTED:
+            setattr(self, name, _InstrumentedGateway(
+                getattr(client, name), name, labels, registry
+            ))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class PrometheusExporter(object):
+    """
+    Render readings in the Prometheus text exposition format
+    """
+    prefix = 'braintree_api'
+
+    def render(self, readings):
+        lines = []
+
+        def add(name, kind, help_):
+            lines.append('# HELP %s_%s %s' % (self.prefix, name, help_))
+            lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+
+        def labels(reading, **extra):
+            values = [
+                ('database', reading['database']),
+                ('gateway', reading['gateway']),
+                ('operation', reading['operation']),
+            ] + sorted(extra.items())
+            return ','.join(
+                '%s="%s"' % (name, _escape(value)) for name, value in values
+            )
+
+        add('duration_seconds', 'histogram', 'Duration of Braintree calls')
+        for reading in readings:
+            for bound, count in reading['buckets']:
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append('%s_duration_seconds_bucket{%s} %d' % (
+                    self.prefix, labels(reading, le=le), count
+                ))
+            lines.append('%s_duration_seconds_sum{%s} %r' % (
+                self.prefix, labels(reading), reading['sum']
+            ))
+            lines.append('%s_duration_seconds_count{%s} %d' % (
+                self.prefix, labels(reading), reading['count']
+            ))
+
+        add('calls_total', 'counter', 'Braintree calls by outcome')
+        for reading in readings:
+            for outcome in OUTCOMES:
+                lines.append('%s_calls_total{%s} %d' % (
+                    self.prefix, labels(reading, outcome=outcome),
+                    reading['outcomes'][outcome]
+                ))
+
+        add('in_flight', 'gauge', 'Braintree calls in progress')
+        for reading in readings:
+            lines.append('%s_in_flight{%s} %d' % (
+                self.prefix, labels(reading), reading['in_flight']
+            ))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdExporter(object):
+    """
+    Send a timer and a counter to statsd over UDP for every call
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='braintree'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host='localhost', port=8125, prefix='braintree'):
+        """
+        Return the exporter registered for the address and prefix, creating
+        it the first time. All the databases share it, as the name of the
+        database is part of the metric names, so a single socket is opened
+        per address however often the clients are rebuilt.
+        """
+        key = (host, port, prefix)
+        with cls._registry_lock:
+            exporter = cls._registry.get(key)
+            if exporter is None:
+                exporter = cls._registry[key] = cls(host, port, prefix)
+            return exporter
+
+    def __eq__(self, other):
+        return isinstance(other, StatsdExporter) and \
+            (self.address, self.prefix) == (other.address, other.prefix)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.address, self.prefix))
+
+    def observe(self, key, outcome, duration):
+        database, gateway, operation = key
+        name = '.'.join([self.prefix, database, str(gateway), operation])
+        payload = '%s.duration:%d|ms\n%s.%s:1|c' % (
+            name, duration * 1000, name, outcome
+        )
+        self._socket.sendto(payload.encode('utf-8'), self.address)
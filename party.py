@@ -5,17 +5,32 @@
     :copyright: (c) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import json
+import logging
+import hashlib
+from datetime import date
+from functools import partial
+
 from trytond.pool import PoolMeta, Pool
 from trytond.model import fields
 from trytond.rpc import RPC
 from trytond.exceptions import UserError
+from trytond.config import config
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond import backend
 
-import braintree
 from braintree.exceptions.braintree_error import BraintreeError
+from braintree.exceptions.not_found_error import NotFoundError
+
+from tools import add_partial_index
+from batch import map_concurrently, BatchReport
 
 __metaclass__ = PoolMeta
 __all__ = ['Address', 'PaymentProfile', 'Party']
 
+logger = logging.getLogger(__name__)
+
 
 class Address:
     __name__ = 'party.address'
@@ -42,6 +57,19 @@ class PaymentProfile:
     braintree_customer_id = fields.Char(
         'Braintree Customer ID', readonly=True
     )
+    braintree_sync_digest = fields.Char(
+        'Braintree Sync Digest', readonly=True,
+        help="Digest of the card details last sent to Braintree"
+    )
+    braintree_expired = fields.Boolean(
+        'Expired on Braintree', readonly=True,
+        help="The card expired or was removed from the Braintree vault "
+        "without being renewed, it can not be charged anymore."
+    )
+
+    @staticmethod
+    def default_braintree_expired():
+        return False
 
     @classmethod
     def __setup__(cls):
@@ -50,27 +78,76 @@ class PaymentProfile:
             'create_profile_using_braintree_token': RPC(
                 instantiate=0, readonly=True
             ),
+            'create_profiles_using_braintree_tokens': RPC(readonly=False),
             'update_braintree': RPC(
                 instantiate=0, readonly=False
             ),
+            'update_braintree_batch': RPC(
+                instantiate=0, readonly=False
+            ),
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentProfile, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Backs the customer id lookup of Party._get_braintree_customer_id,
+        # only the few profiles which have a customer id are indexed
+        add_partial_index(
+            table, 'party_payment_profile_braintree_customer_index',
+            ['party', 'gateway'], '"braintree_customer_id" IS NOT NULL'
+        )
+        # Backs the lookup of profiles by card token
+        table.index_action(['gateway', 'provider_reference'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        profiles = super(PaymentProfile, cls).create(vlist)
+        if any(v.get('braintree_customer_id') for v in vlist):
+            cls._clear_braintree_customer_id_cache()
+        return profiles
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        clear = False
+        for profiles, values in zip(actions, actions):
+            # Only the fields of the customer id lookup matter, the syncs
+            # write digests and card details in bulk
+            if 'braintree_customer_id' in values or (
+                    set(values) & set(['party', 'gateway', 'active']) and
+                    any(p.braintree_customer_id for p in profiles)):
+                clear = True
+        super(PaymentProfile, cls).write(*args)
+        if clear:
+            cls._clear_braintree_customer_id_cache()
+
+    @classmethod
+    def delete(cls, profiles):
+        clear = any(p.braintree_customer_id for p in profiles)
+        super(PaymentProfile, cls).delete(profiles)
+        if clear:
+            cls._clear_braintree_customer_id_cache()
+
+    @staticmethod
+    def _clear_braintree_customer_id_cache():
+        Party = Pool().get('party.party')
+        Party._get_braintree_customer_id_cache().clear()
+
     def update_braintree(self):
         """
         Update this payment profile on the gateway (braintree)
         """
         assert self.gateway.provider == 'braintree'
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
+        card_data = self.get_braintree_card_data()
         try:
-            card = braintree.CreditCard.update(
-                self.provider_reference,
-                {
-                    'cardholder_name': self.name or self.party.name,
-                    'expiration_month': self.expiry_month,
-                    'expiration_year': self.expiry_year,
-                    'billing_address': self.address.get_address_for_braintree(),
-                }
+            card = client.credit_card.update(
+                self.provider_reference, card_data
             )
         except BraintreeError as exc:
             raise UserError(exc)
@@ -78,6 +155,207 @@ class PaymentProfile:
         if not card.is_success:
             for error in card.errors.deep_errors:
                 raise UserError(error.message)
+        self.write([self], {
+            'braintree_sync_digest': self._braintree_digest(card_data),
+        })
+
+    def get_braintree_card_data(self):
+        """
+        Return the card details of the profile sent to Braintree
+        """
+        return {
+            'cardholder_name': self.name or self.party.name,
+            'expiration_month': self.expiry_month,
+            'expiration_year': self.expiry_year,
+            'billing_address': self.address.get_address_for_braintree(),
+        }
+
+    @staticmethod
+    def _braintree_digest(card_data):
+        return hashlib.sha1(
+            json.dumps(card_data, sort_keys=True, default=unicode)
+        ).hexdigest()
+
+    @classmethod
+    def update_braintree_batch(cls, profiles, workers=None):
+        """
+        Update many profiles on Braintree.
+
+        Profiles whose card details did not change since they were last
+        sent are skipped. The others are updated concurrently through a
+        pool of `workers` threads, starting at most `update_rate_limit`
+        calls per second (from the `braintree` configuration section,
+        unlimited by default).
+
+        Returns a dictionary with the outcome of every profile (updated,
+        unchanged or failed), throughput figures and the ids of the failed
+        profiles grouped by error message.
+        """
+        report = BatchReport()
+        rate = config.getfloat('braintree', 'update_rate_limit', default=0)
+
+        jobs = []
+        for profile in cls.browse([p.id for p in profiles]):
+            assert profile.gateway.provider == 'braintree'
+            card_data = profile.get_braintree_card_data()
+            digest = cls._braintree_digest(card_data)
+            if digest == profile.braintree_sync_digest:
+                report.add(profile, 'unchanged')
+                continue
+            client = profile.gateway.get_braintree_client()
+            jobs.append((profile, digest, partial(
+                client.credit_card.update, profile.provider_reference,
+                card_data
+            )))
+
+        results = map_concurrently(
+            lambda job: job[2](), jobs, workers, rate=rate or None
+        )
+
+        to_write, errors = [], {}
+        for (profile, digest, _), (result, exc) in zip(jobs, results):
+            if exc is None and result.is_success:
+                report.add(profile, 'updated')
+                to_write.extend((
+                    [profile], {'braintree_sync_digest': digest}
+                ))
+                continue
+            report.add(profile, 'failed')
+            if exc is not None:
+                message = unicode(exc) or exc.__class__.__name__
+            else:
+                message = '\n'.join(
+                    error.message for error in result.errors.deep_errors
+                ) or result.message
+            errors.setdefault(message, []).append(profile.id)
+        if to_write:
+            cls.write(*to_write)
+
+        outcome = report.stop().as_dict()
+        outcome['errors'] = errors
+        return outcome
+
+    @classmethod
+    def sync_braintree_expiring_cards(cls):
+        """
+        Bring the profiles of the cards which expired during the last
+        `card_expiry_lookback` months or expire within the next
+        `card_expiry_lookahead` months (from the `braintree` configuration
+        section) in line with the Braintree vault, where the account
+        updater may have renewed them. Cards which expired or were removed
+        from the vault are flagged as expired.
+
+        Meant to be run by the scheduler. Returns the number of profiles
+        updated and flagged.
+        """
+        PaymentGateway = Pool().get('payment_gateway.gateway')
+
+        today = date.today()
+        month = today.year * 12 + today.month - 1
+        start = month - config.getint(
+            'braintree', 'card_expiry_lookback', default=12
+        )
+        end = month + config.getint(
+            'braintree', 'card_expiry_lookahead', default=1
+        )
+        months = [(m // 12, m % 12 + 1) for m in xrange(start, end + 1)]
+
+        stats = {'updated': 0, 'expired': 0}
+        for gateway in PaymentGateway.search([
+                ('provider', '=', 'braintree'),
+                ]):
+            for key, value in cls._sync_braintree_expiring_cards(
+                    gateway, months).iteritems():
+                stats[key] += value
+        logger.info('Braintree expiring cards synchronised: %s', stats)
+        return stats
+
+    @classmethod
+    def _sync_braintree_expiring_cards(cls, gateway, months):
+        """
+        Synchronise the profiles of the gateway whose card expires in one of
+        the `(year, month)` of `months`.
+
+        The cards Braintree still sees expiring in that range are streamed
+        and matched by token chunk by chunk. The other profiles expiring in
+        the range were renewed or removed, their cards are looked up one by
+        one through a pool of threads.
+        """
+        client = gateway.get_braintree_client()
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        first, last = months[0], months[-1]
+        result = client.credit_card.expiring_between(
+            date(first[0], first[1], 1), date(last[0], last[1], 1)
+        )
+
+        stats = {'updated': 0, 'expired': 0}
+        seen, chunk = set(), []
+        for card in result.items:
+            seen.add(card.token)
+            chunk.append(card)
+            if len(chunk) >= chunk_size:
+                cls._update_braintree_expiring_profiles(gateway, chunk, stats)
+                chunk = []
+        if chunk:
+            cls._update_braintree_expiring_profiles(gateway, chunk, stats)
+
+        unseen = [p for p in cls.search([
+            ('gateway', '=', gateway.id),
+            ('braintree_expired', '=', False),
+            ['OR'] + [[
+                ('expiry_year', '=', str(year)),
+                ('expiry_month', '=', '%02d' % month),
+            ] for year, month in months],
+        ]) if p.provider_reference not in seen]
+        results = map_concurrently(
+            client.credit_card.find, [p.provider_reference for p in unseen]
+        )
+        cards, removed = [], []
+        for profile, (card, exc) in zip(unseen, results):
+            if isinstance(exc, NotFoundError):
+                removed.append(profile)
+            elif exc is not None:
+                logger.warning(
+                    'Braintree card of profile %s not synchronised: %s',
+                    profile.id, exc
+                )
+            else:
+                cards.append(card)
+        for index in xrange(0, len(cards), chunk_size):
+            cls._update_braintree_expiring_profiles(
+                gateway, cards[index:index + chunk_size], stats
+            )
+        if removed:
+            cls.write(removed, {'braintree_expired': True})
+            stats['expired'] += len(removed)
+        return stats
+
+    @classmethod
+    def _update_braintree_expiring_profiles(cls, gateway, cards, stats):
+        """
+        Write in bulk the details of the Braintree cards on their profiles
+        """
+        cards = dict((card.token, card) for card in cards)
+        to_write = []
+        for profile in cls.search([
+                ('gateway', '=', gateway.id),
+                ('provider_reference', 'in', cards.keys()),
+                ]):
+            card = cards[profile.provider_reference]
+            values = {
+                'expiry_month': card.expiration_month,
+                'expiry_year': card.expiration_year,
+                'last_4_digits': card.last_4,
+                'braintree_expired': bool(card.expired),
+            }
+            if all(getattr(profile, k) == v for k, v in values.iteritems()):
+                continue
+            to_write.extend(([profile], values))
+            stats['expired' if card.expired else 'updated'] += 1
+        if to_write:
+            cls.write(*to_write)
 
     @classmethod
     def create_profile_using_braintree_token(
@@ -93,48 +371,150 @@ class PaymentProfile:
         party = Party(user_id)
         gateway = PaymentGateway(gateway_id)
         assert gateway.provider == 'braintree'
-        gateway.configure_braintree_client()
+        client = gateway.get_braintree_client()
 
         try:
-            card = braintree.CreditCard.find(token)
+            card = client.credit_card.find(token)
         except BraintreeError as exc:
             raise UserError(exc)
         else:
-            profile, = PaymentProfile.create([{
-                'name': card.cardholder_name,
-                'party': party.id,
-                'address': address_id or party.addresses[0].id,
-                'gateway': gateway.id,
-                'last_4_digits': card.last_4,
-                'expiry_month': card.expiration_month,
-                'expiry_year': card.expiration_year,
-                'provider_reference': card.token,
-                'braintree_customer_id': card.customer_id,
-            }])
+            profile, = PaymentProfile.create([
+                cls._get_braintree_profile_values(
+                    card, party, gateway, address_id
+                )
+            ])
 
             return profile.id
 
+    @classmethod
+    def create_profiles_using_braintree_tokens(
+        cls, user_id, gateway_id, tokens, address_id=None, workers=None
+    ):
+        """
+        Create the Payment Profiles of many tokens
+
+        The tokens are looked up concurrently through a pool of `workers`
+        threads and the profiles created together. Returns a list with,
+        for each token, a dictionary with the `token` and either the id of
+        its `profile` or the `error` raised while looking it up.
+        """
+        Party = Pool().get('party.party')
+        PaymentGateway = Pool().get('payment_gateway.gateway')
+
+        party = Party(user_id)
+        gateway = PaymentGateway(gateway_id)
+        assert gateway.provider == 'braintree'
+        client = gateway.get_braintree_client()
+
+        results = map_concurrently(client.credit_card.find, tokens, workers)
+
+        vlist, outcomes = [], []
+        for token, (card, exc) in zip(tokens, results):
+            if exc is not None:
+                outcomes.append({'token': token, 'error': unicode(exc)})
+                continue
+            vlist.append(cls._get_braintree_profile_values(
+                card, party, gateway, address_id
+            ))
+            outcomes.append({'token': token})
+
+        profiles = iter(cls.create(vlist))
+        for outcome in outcomes:
+            if 'error' not in outcome:
+                outcome['profile'] = next(profiles).id
+        return outcomes
+
+    @staticmethod
+    def _get_braintree_profile_values(card, party, gateway, address_id=None):
+        """
+        Return the values of the payment profile of a Braintree credit card
+        """
+        return {
+            'name': card.cardholder_name,
+            'party': party.id,
+            'address': address_id or party.addresses[0].id,
+            'gateway': gateway.id,
+            'last_4_digits': card.last_4,
+            'expiry_month': card.expiration_month,
+            'expiry_year': card.expiration_year,
+            'provider_reference': card.token,
+            'braintree_customer_id': card.customer_id,
+        }
+
 
 class Party:
     __name__ = 'party.party'
 
+    @staticmethod
+    def _get_braintree_customer_id_cache():
+        """
+        Return the customer ids memoized by `(party id, gateway id)` in the
+        current transaction.
+
+        The memo lives and dies with the transaction, so ids read from
+        uncommitted records, or their absence, never leak to other
+        transactions.
+        """
+        return Transaction().cache.setdefault(
+            'party.party.braintree_customer_id', {}
+        )
+
     def _get_braintree_customer_id(self, gateway):
         """
         Extracts and returns customer id from party's payment profile
         Return None if no customer id is found.
 
+        The result is memoized per party and gateway for the rest of the
+        transaction, unless a payment profile with a customer id is created,
+        modified or deleted.
+
         :param gateway: Payment gateway to which the customer id is associated
         """
         PaymentProfile = Pool().get('party.payment_profile')
 
+        cache = self._get_braintree_customer_id_cache()
+        key = (self.id, gateway.id)
+        if key in cache:
+            return cache[key]
+
         payment_profiles = PaymentProfile.search([
             ('party', '=', self.id),
             ('braintree_customer_id', '!=', None),
             ('gateway', '=', gateway.id),
-        ])
+        ], limit=1)
         if payment_profiles:
-            return payment_profiles[0].braintree_customer_id
-        return None
+            customer_id = payment_profiles[0].braintree_customer_id
+        else:
+            customer_id = None
+        cache[key] = customer_id
+        return customer_id
+
+    @classmethod
+    def _prefetch_braintree_customer_ids(cls, keys):
+        """
+        Fill the customer id cache for many `(party id, gateway id)` keys
+        with a search per slice of parties instead of one per key.
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        cache = cls._get_braintree_customer_id_cache()
+        keys = set(k for k in keys if k not in cache)
+        if not keys:
+            return
+        customer_ids = {}
+        gateway_ids = list(set(gateway for _, gateway in keys))
+        for party_ids in grouped_slice(set(party for party, _ in keys)):
+            for profile in PaymentProfile.search([
+                    ('party', 'in', list(party_ids)),
+                    ('braintree_customer_id', '!=', None),
+                    ('gateway', 'in', gateway_ids),
+                    ]):
+                customer_ids.setdefault(
+                    (profile.party.id, profile.gateway.id),
+                    profile.braintree_customer_id
+                )
+        for key in keys:
+            cache[key] = customer_ids.get(key)
 
     def get_customer_for_braintree(self):
         return {
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+    reconciliation.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import logging
+from datetime import timedelta
+
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.config import config
+
+import braintree
+
+from transaction import BRAINTREE_STATES
+
+__all__ = ['BraintreeReconciliation', 'BraintreeReconciliationLine']
+
+logger = logging.getLogger(__name__)
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+}
+DEPENDS = ['state']
+
+
+class BraintreeReconciliation(ModelSQL, ModelView):
+    "Braintree Reconciliation"
+    __name__ = 'payment_gateway.braintree.reconciliation'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True,
+        domain=[('provider', '=', 'braintree')],
+        states=STATES, depends=DEPENDS
+    )
+    start = fields.DateTime(
+        'Start', required=True, states=STATES, depends=DEPENDS
+    )
+    end = fields.DateTime(
+        'End', required=True, states=STATES, depends=DEPENDS
+    )
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
+    braintree_count = fields.Integer('Braintree Transactions', readonly=True)
+    lines = fields.One2Many(
+        'payment_gateway.braintree.reconciliation.line', 'reconciliation',
+        'Mismatches', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(BraintreeReconciliation, cls).__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+        cls._buttons.update({
+            'reconcile': {
+                'invisible': Eval('state') != 'draft',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_braintree_count():
+        return 0
+
+    @classmethod
+    @ModelView.button
+    def reconcile(cls, reconciliations):
+        for reconciliation in reconciliations:
+            reconciliation.reconcile_braintree()
+
+    def reconcile_braintree(self):
+        """
+        Compare the Braintree transactions created between `start` and
+        `end` with the local transactions and record the mismatches.
+
+        The range is searched one window of `reconcile_window` seconds
+        (from the `braintree` configuration section) at a time and the
+        results of each window are read page by page, so the memory used
+        does not depend on the length of the range.
+        """
+        client = self.gateway.get_braintree_client()
+        window = timedelta(seconds=config.getint(
+            'braintree', 'reconcile_window', default=86400
+        ))
+
+        count = 0
+        start = self.start
+        while start < self.end:
+            end = min(start + window, self.end)
+            count += self._reconcile_braintree_window(client, start, end)
+            start = end
+
+        self.state = 'done'
+        self.braintree_count = count
+        self.save()
+        logger.info(
+            'Braintree reconciliation %s: %d transactions, %d mismatches',
+            self.id, count, len(self.lines)
+        )
+
+    def _reconcile_braintree_window(self, client, start, end):
+        """
+        Reconcile the transactions created from `start` until `end`, which
+        is excluded unless it is the end of the reconciliation.
+
+        Returns the number of Braintree transactions compared.
+        """
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        result = client.transaction.search(
+            braintree.TransactionSearch.created_at.between(start, end)
+        )
+
+        seen, chunk = set(), []
+        for txn in result.items:
+            if txn.created_at >= end and end != self.end:
+                continue
+            seen.add(txn.id)
+            chunk.append(txn)
+            if len(chunk) >= chunk_size:
+                self._match_braintree_transactions(chunk)
+                chunk = []
+        if chunk:
+            self._match_braintree_transactions(chunk)
+
+        self._find_missing_on_braintree(client, start, end, seen)
+        return len(seen)
+
+    def _match_braintree_transactions(self, txns):
+        """
+        Record the mismatches between Braintree transactions and the local
+        transactions having them as reference.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Line = pool.get('payment_gateway.braintree.reconciliation.line')
+
+        local = {}
+        for transaction in PaymentTransaction.search([
+                ('gateway', '=', self.gateway.id),
+                ('provider_reference', 'in', [txn.id for txn in txns]),
+                ]):
+            local[(transaction.provider_reference, transaction.type)] = \
+                transaction
+
+        vlist = []
+        for txn in txns:
+            type_ = 'refund' if txn.type == 'credit' else 'charge'
+            transaction = local.get((txn.id, type_))
+            if transaction is None:
+                vlist.append(self._get_line_values(
+                    'missing_local', txn=txn, type_=type_
+                ))
+                continue
+            if txn.amount != transaction.amount:
+                vlist.append(self._get_line_values(
+                    'amount', transaction, txn
+                ))
+            if not self._braintree_state_matches(transaction, txn.status):
+                vlist.append(self._get_line_values(
+                    'state', transaction, txn
+                ))
+        if vlist:
+            Line.create(vlist)
+
+    @staticmethod
+    def _braintree_state_matches(transaction, status):
+        """
+        Tell if the local state of the transaction is the one implied by
+        its Braintree status.
+
+        Statuses already recorded on the transaction are trusted, the
+        module does not apply every status change on purpose (like the
+        void of a charge by one of its refunds).
+        """
+        state = BRAINTREE_STATES.get(status)
+        local_state = transaction.state
+        if local_state == 'posted':
+            local_state = 'completed'
+        return state in (None, 'in-progress', local_state) or \
+            transaction.braintree_status == status
+
+    def _find_missing_on_braintree(self, client, start, end, seen):
+        """
+        Record the local transactions created from `start` until `end`
+        whose reference was not found on Braintree.
+
+        References missing from the window are looked up again by id, the
+        transaction may have been created on Braintree in another window.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Line = pool.get('payment_gateway.braintree.reconciliation.line')
+
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        domain = [
+            ('gateway', '=', self.gateway.id),
+            ('provider_reference', '!=', None),
+            ('create_date', '>=', start),
+            ('create_date', '<=' if end == self.end else '<', end),
+        ]
+        last_id = 0
+        while True:
+            transactions = PaymentTransaction.search(
+                [('id', '>', last_id)] + domain,
+                order=[('id', 'ASC')], limit=chunk_size
+            )
+            if not transactions:
+                break
+            last_id = transactions[-1].id
+
+            unseen = [
+                t for t in transactions if t.provider_reference not in seen
+            ]
+            if not unseen:
+                continue
+            found = set(txn.id for txn in client.transaction.search(
+                braintree.TransactionSearch.ids.in_list(
+                    list(set(t.provider_reference for t in unseen))
+                )
+            ).items)
+            vlist = [
+                self._get_line_values('missing_braintree', transaction)
+                for transaction in unseen
+                if transaction.provider_reference not in found
+            ]
+            if vlist:
+                Line.create(vlist)
+
+    def _get_line_values(self, kind, transaction=None, txn=None, type_=None):
+        values = {
+            'reconciliation': self.id,
+            'kind': kind,
+        }
+        if transaction is not None:
+            values.update({
+                'transaction': transaction.id,
+                'provider_reference': transaction.provider_reference,
+                'type': transaction.type,
+                'local_amount': transaction.amount,
+                'local_state': transaction.state,
+            })
+        if txn is not None:
+            values.update({
+                'provider_reference': txn.id,
+                'braintree_amount': txn.amount,
+                'braintree_status': txn.status,
+                'braintree_date': txn.created_at,
+            })
+        if type_ is not None:
+            values['type'] = type_
+        return values
+
+
+class BraintreeReconciliationLine(ModelSQL, ModelView):
+    "Braintree Reconciliation Line"
+    __name__ = 'payment_gateway.braintree.reconciliation.line'
+
+    reconciliation = fields.Many2One(
+        'payment_gateway.braintree.reconciliation', 'Reconciliation',
+        required=True, readonly=True, select=True, ondelete='CASCADE'
+    )
+    kind = fields.Selection([
+        ('amount', 'Amount Mismatch'),
+        ('state', 'State Mismatch'),
+        ('missing_local', 'Missing Locally'),
+        ('missing_braintree', 'Missing on Braintree'),
+    ], 'Kind', required=True, readonly=True, select=True)
+    provider_reference = fields.Char('Provider Reference', readonly=True)
+    type = fields.Selection([
+        ('charge', 'Charge'),
+        ('refund', 'Refund'),
+    ], 'Type', readonly=True)
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True
+    )
+    local_amount = fields.Numeric('Local Amount', readonly=True)
+    local_state = fields.Char('Local State', readonly=True)
+    braintree_amount = fields.Numeric('Braintree Amount', readonly=True)
+    braintree_status = fields.Char('Braintree Status', readonly=True)
+    braintree_date = fields.DateTime('Braintree Date', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BraintreeReconciliationLine, cls).__setup__()
+        cls._order.insert(0, ('kind', 'ASC'))
@@ -14,6 +14,13 @@ from trytond.pool import Pool
 from dateutil.relativedelta import relativedelta
 import pytest
 
+# Sandbox account the test gateway is configured with
+BRAINTREE_CREDENTIALS = {
+    'merchant_id': 't3scq4k2ckwrxsnr',
+    'public_key': 'yxr8yz65qxw87748',
+    'private_key': '1384640ad456f37934cc365fb6773f17',
+}
+
 
 def pytest_addoption(parser):
 
@@ -29,6 +36,26 @@ def pytest_addoption(parser):
         "--reset-db", action="store_true", default=False,
         help="Clear local database and initialise"
         )
+    parser.addoption(
+        "--fake-braintree", action="store_true", default=False,
+        help="Run every test against a local fake Braintree server"
+        )
+    parser.addoption(
+        "--benchmark", action="store_true", default=False,
+        help="Run the benchmarks"
+        )
+    parser.addoption(
+        "--benchmark-size", action="store", type=int, default=100000,
+        help="Number of records generated by the benchmarks"
+        )
+    parser.addoption(
+        "--benchmark-calls", action="store", type=int, default=200,
+        help="Number of payments processed by the throughput benchmarks"
+        )
+    parser.addoption(
+        "--benchmark-latency", action="store", type=float, default=0.02,
+        help="Latency in seconds of the fake Braintree server"
+        )
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -265,9 +292,9 @@ def dataset(request):
             journal=cash_journal,
             provider='braintree',
             method='credit_card',
-            braintree_api_key="1384640ad456f37934cc365fb6773f17",
-            braintree_public_key="yxr8yz65qxw87748",
-            braintree_merchant_id="t3scq4k2ckwrxsnr",
+            braintree_api_key=BRAINTREE_CREDENTIALS['private_key'],
+            braintree_public_key=BRAINTREE_CREDENTIALS['public_key'],
+            braintree_merchant_id=BRAINTREE_CREDENTIALS['merchant_id'],
             braintree_currency=usd,
             test=True
         )
@@ -292,3 +319,28 @@ def dataset(request):
     return get
 
 
+@pytest.yield_fixture()
+def fake_braintree(request, monkeypatch):
+    """Start a local fake Braintree server and point every gateway to it.
+    """
+    from trytond.tests.test_tryton import POOL
+    from fake_braintree import FakeBraintreeServer
+
+    server = FakeBraintreeServer().start()
+    PaymentGateway = POOL.get('payment_gateway.gateway')
+    monkeypatch.setattr(
+        PaymentGateway, 'get_braintree_environment',
+        lambda self: server.environment
+    )
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def offline_braintree(request):
+    """Use the fake Braintree server for every test with --fake-braintree.
+    """
+    if request.config.getoption('--fake-braintree'):
+        request.getfixturevalue('fake_braintree').add_merchant(
+            **BRAINTREE_CREDENTIALS
+        )
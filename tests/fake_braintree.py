@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/fake_braintree.py
+
+    A local stand-in for the Braintree gateway API, good enough to drive the
+    module without network access.
+
+    :copyright: (C) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import re
+import time
+import base64
+import random
+import threading
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+from itertools import count
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import braintree
+from braintree.util.xml_util import XmlUtil
+
+ROUTES = []
+
+
+def route(verb, pattern):
+    def decorator(func):
+        ROUTES.append((verb, re.compile(r'^/merchants/(\w+)' + pattern + '$'),
+                       func))
+        return func
+    return decorator
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeBraintreeServer(object):
+    """
+    Serve the subset of the Braintree XML API used by the module from
+    memory. Every merchant must be registered with its API keys and each
+    request is checked against them, so tests can detect credentials leaking
+    from one gateway to another.
+
+    Like the sandbox, sales of 2000.00 to 2999.99 are declined by the
+    processor.
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        self.merchants = {}
+        self.transactions = {}
+        self.customers = {}
+        self.credit_cards = {}
+        self.requests = []
+        self.auth_failures = []
+        # Seconds every request takes to be answered
+        self.latency = latency
+        # Share of the requests answered with a server error without being
+        # processed
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # When set, every request is answered with this HTTP status
+        self.outage_status = None
+        # (status, processed) pairs answering the next requests instead of
+        # the normal response. Processed requests take effect anyway.
+        self.faults = deque()
+        self.lock = threading.Lock()
+        self._ids = count(1)
+        self._server = None
+        self._thread = None
+
+    def add_merchant(self, merchant_id, public_key, private_key):
+        self.merchants[merchant_id] = base64.b64encode(
+            '%s:%s' % (public_key, private_key)
+        )
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def environment(self):
+        return braintree.Environment(
+            'fake', '127.0.0.1', str(self.port), 'http://127.0.0.1', False,
+            None
+        )
+
+    def start(self):
+        server = self
+
+        class Handler(FakeBraintreeHandler):
+            fake = server
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def next_id(self, merchant_id):
+        # Prefix ids with the merchant so tests can tell who created them
+        with self.lock:
+            return '%s-%d' % (merchant_id, next(self._ids))
+
+    def error_response(self, message, code='81502', attribute='amount',
+                       path=('transaction',)):
+        errors = {'errors': [{
+            'code': code,
+            'attribute': attribute,
+            'message': message,
+        }]}
+        for key in reversed(path):
+            errors = {key: errors}
+        return 422, {'api_error_response': {
+            'message': message,
+            'errors': errors,
+            'params': {},
+        }}
+
+    def inject_error(self):
+        """
+        Return whether the current request should fail, per `error_rate`
+        """
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    @route('POST', '/transactions')
+    def sale(self, merchant_id, body):
+        data = body['transaction']
+        amount = Decimal(data['amount'])
+        if amount <= 0:
+            return self.error_response('Amount must be greater than zero.')
+
+        options = data.get('options') or {}
+        transaction = {
+            'id': self.next_id(merchant_id),
+            'merchant_id': merchant_id,
+            'type': 'sale',
+            'amount': str(amount),
+            'tax_amount': None,
+            'order_id': data.get('order_id'),
+            'created_at': datetime.utcnow().replace(microsecond=0),
+            'status': 'submitted_for_settlement' if options.get(
+                'submit_for_settlement'
+            ) else 'authorized',
+        }
+        if 2000 <= amount < 3000:
+            transaction.update({
+                'status': 'processor_declined',
+                'processor_response_code': str(int(amount)),
+                'processor_response_text': 'Do Not Honor',
+            })
+        elif options.get('store_in_vault_on_success') and \
+                data.get('credit_card'):
+            error = self.store_in_vault(merchant_id, data, transaction)
+            if error:
+                return error
+        with self.lock:
+            self.transactions[transaction['id']] = transaction
+        if transaction['status'] == 'processor_declined':
+            return 422, {'api_error_response': {
+                'message': 'Do Not Honor',
+                'errors': {'transaction': {'errors': []}},
+                'transaction': transaction,
+                'params': {},
+            }}
+        return 201, {'transaction': transaction}
+
+    def store_in_vault(self, merchant_id, data, transaction):
+        """
+        Save the card of a sale, under a new customer unless the sale
+        names one. Return an error response if the card is invalid.
+        """
+        customer = self.customers.get(data.get('customer_id'))
+        if customer is None or customer['merchant_id'] != merchant_id:
+            customer = dict(
+                data.get('customer') or {}, id=self.next_id(merchant_id),
+                merchant_id=merchant_id, credit_cards=[],
+                created_at=datetime.utcnow().replace(microsecond=0),
+            )
+        card_data = dict(data['credit_card'])
+        if data.get('billing'):
+            card_data['billing_address'] = data['billing']
+        error, card = self.create_credit_card(
+            merchant_id, customer['id'], card_data,
+            ('transaction', 'credit_card')
+        )
+        if error:
+            return error
+        with self.lock:
+            customer['credit_cards'].append(card)
+            self.customers[customer['id']] = customer
+        transaction['credit_card'] = card
+        transaction['customer'] = {'id': customer['id']}
+
+    @route('PUT', r'/transactions/([\w-]+)/submit_for_settlement')
+    def submit_for_settlement(self, merchant_id, body, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None or transaction['merchant_id'] != merchant_id:
+            return 404, None
+        amount = Decimal((body['transaction'] or {}).get('amount') or
+                         transaction['amount'])
+        if transaction['status'] != 'authorized':
+            return self.error_response(
+                'Cannot submit for settlement unless status is authorized.',
+                code='91507', attribute='base'
+            )
+        if amount > Decimal(transaction['amount']):
+            return self.error_response(
+                'Settlement amount is too large.', code='91522'
+            )
+        transaction.update({
+            'status': 'submitted_for_settlement',
+            'amount': str(amount),
+        })
+        return 200, {'transaction': transaction}
+
+    @route('PUT', r'/transactions/([\w-]+)/void')
+    def void(self, merchant_id, body, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None or transaction['merchant_id'] != merchant_id:
+            return 404, None
+        if transaction['status'] not in (
+                'authorized', 'submitted_for_settlement'):
+            return self.error_response(
+                'Transaction can only be voided if status is authorized or '
+                'submitted_for_settlement.', code='91504', attribute='base'
+            )
+        transaction['status'] = 'voided'
+        return 200, {'transaction': transaction}
+
+    @route('POST', r'/transactions/([\w-]+)/refund')
+    def refund(self, merchant_id, body, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None or transaction['merchant_id'] != merchant_id:
+            return 404, None
+        if transaction['status'] not in ('settling', 'settled'):
+            return self.error_response(
+                'Cannot refund a transaction unless it is settled.',
+                code='91506', attribute='base'
+            )
+        amount = Decimal((body.get('transaction') or {}).get('amount') or
+                         transaction['amount'])
+        refund = {
+            'id': self.next_id(merchant_id),
+            'merchant_id': merchant_id,
+            'type': 'credit',
+            'amount': str(amount),
+            'tax_amount': None,
+            'created_at': datetime.utcnow().replace(microsecond=0),
+            'status': 'submitted_for_settlement',
+        }
+        with self.lock:
+            self.transactions[refund['id']] = refund
+        return 201, {'transaction': refund}
+
+    def search_transactions(self, merchant_id, criteria):
+        ids = criteria.get('ids')
+        order_id = (criteria.get('order_id') or {}).get('is')
+        created_at = criteria.get('created_at') or {}
+        with self.lock:
+            transactions = [
+                txn for txn in self.transactions.values()
+                if txn['merchant_id'] == merchant_id and
+                (ids is None or txn['id'] in ids) and
+                (order_id is None or txn.get('order_id') == order_id) and
+                created_at.get('min', txn['created_at']) <=
+                txn['created_at'] <= created_at.get('max', txn['created_at'])
+            ]
+        return sorted(transactions, key=lambda txn: txn['id'])
+
+    @route('POST', '/transactions/advanced_search_ids')
+    def search_ids(self, merchant_id, body):
+        transactions = self.search_transactions(merchant_id, body['search'])
+        return 200, {'search_results': {
+            'page_size': 50,
+            'ids': [txn['id'] for txn in transactions],
+        }}
+
+    @route('POST', '/transactions/advanced_search')
+    def search(self, merchant_id, body):
+        transactions = self.search_transactions(merchant_id, body['search'])
+        return 200, {'credit_card_transactions': {
+            'transaction': transactions,
+        }}
+
+    @route('GET', r'/transactions/([\w-]+)')
+    def find(self, merchant_id, body, transaction_id):
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None or transaction['merchant_id'] != merchant_id:
+            return 404, None
+        return 200, {'transaction': transaction}
+
+    def create_credit_card(self, merchant_id, customer_id, data, path):
+        """
+        Return a new credit card or an error response
+        """
+        number = data.get('number') or ''
+        if not number.isdigit() or not 12 <= len(number) <= 19:
+            return self.error_response(
+                'Credit card number is invalid.', code='81715',
+                attribute='number', path=path
+            )
+        if data.get('expiration_date'):
+            month, year = data['expiration_date'].split('/')
+        else:
+            month = data.get('expiration_month')
+            year = data.get('expiration_year')
+        card = {
+            'token': self.next_id(merchant_id),
+            'merchant_id': merchant_id,
+            'customer_id': customer_id,
+            'cardholder_name': data.get('cardholder_name'),
+            'bin': number[:6],
+            'last_4': number[-4:],
+            'card_type': 'Visa',
+            'expiration_month': month,
+            'expiration_year': year,
+            'expired': False,
+        }
+        if data.get('billing_address'):
+            card['billing_address'] = data['billing_address']
+        with self.lock:
+            self.credit_cards[card['token']] = card
+        return None, card
+
+    @route('POST', '/customers')
+    def create_customer(self, merchant_id, body):
+        data = dict(body['customer'] or {})
+        card_data = data.pop('credit_card', None)
+        customer = dict(data, id=self.next_id(merchant_id),
+                        merchant_id=merchant_id, credit_cards=[],
+                        created_at=datetime.utcnow().replace(microsecond=0))
+        if card_data:
+            error, card = self.create_credit_card(
+                merchant_id, customer['id'], card_data,
+                ('customer', 'credit_card')
+            )
+            if error:
+                return error, card
+            customer['credit_cards'].append(card)
+        with self.lock:
+            self.customers[customer['id']] = customer
+        return 201, {'customer': customer}
+
+    def search_customers(self, merchant_id, criteria):
+        ids = criteria.get('ids')
+        created_at = criteria.get('created_at') or {}
+        with self.lock:
+            customers = [
+                customer for customer in self.customers.values()
+                if customer['merchant_id'] == merchant_id and
+                (ids is None or customer['id'] in ids) and
+                created_at.get('min', customer['created_at']) <=
+                customer['created_at'] <=
+                created_at.get('max', customer['created_at'])
+            ]
+        return sorted(customers, key=lambda customer: customer['id'])
+
+    @route('POST', '/customers/advanced_search_ids')
+    def search_customer_ids(self, merchant_id, body):
+        customers = self.search_customers(
+            merchant_id, body.get('search') or {}
+        )
+        return 200, {'search_results': {
+            'page_size': 50,
+            'ids': [customer['id'] for customer in customers],
+        }}
+
+    @route('POST', '/customers/advanced_search')
+    def search_customers_page(self, merchant_id, body):
+        customers = self.search_customers(merchant_id, body['search'])
+        return 200, {'customers': {'customer': customers}}
+
+    @route('GET', r'/customers/([\w-]+)')
+    def find_customer(self, merchant_id, body, customer_id):
+        customer = self.customers.get(customer_id)
+        if customer is None or customer['merchant_id'] != merchant_id:
+            return 404, None
+        return 200, {'customer': customer}
+
+    @route('POST', '/payment_methods')
+    def create_payment_method(self, merchant_id, body):
+        data = body['credit_card']
+        customer = self.customers.get(data.get('customer_id'))
+        if customer is None or customer['merchant_id'] != merchant_id:
+            return self.error_response(
+                'Customer ID is invalid.', code='91705',
+                attribute='customer_id', path=('credit_card',)
+            )
+        error, card = self.create_credit_card(
+            merchant_id, customer['id'], data, ('credit_card',)
+        )
+        if error:
+            return error, card
+        customer['credit_cards'].append(card)
+        return 201, {'credit_card': card}
+
+    @route('GET', r'/payment_methods/credit_card/([\w-]+)')
+    def find_credit_card(self, merchant_id, body, token):
+        card = self.credit_cards.get(token)
+        if card is None or card['merchant_id'] != merchant_id:
+            return 404, None
+        return 200, {'credit_card': card}
+
+    @route('PUT', r'/payment_methods/credit_card/([\w-]+)')
+    def update_credit_card(self, merchant_id, body, token):
+        card = self.credit_cards.get(token)
+        if card is None or card['merchant_id'] != merchant_id:
+            return 404, None
+        data = body['credit_card']
+        for name in [
+                'cardholder_name', 'expiration_month', 'expiration_year']:
+            if data.get(name) is not None:
+                card[name] = data[name]
+        if data.get('billing_address'):
+            card['billing_address'] = data['billing_address']
+        return 200, {'credit_card': card}
+
+    def search_expiring_cards(self, merchant_id, start, end):
+        """
+        Return the cards expiring from the `start` month to the `end` month
+        included, both given as MMYYYY
+        """
+        start = (int(start[2:]), int(start[:2]))
+        end = (int(end[2:]), int(end[:2]))
+        with self.lock:
+            cards = [
+                card for card in self.credit_cards.values()
+                if card['merchant_id'] == merchant_id and
+                start <= (int(card['expiration_year']),
+                          int(card['expiration_month'])) <= end
+            ]
+        return sorted(cards, key=lambda card: card['token'])
+
+    @route('POST', r'/payment_methods/all/expiring_ids\?start=(\d+)&end=(\d+)')
+    def search_expiring_ids(self, merchant_id, body, start, end):
+        cards = self.search_expiring_cards(merchant_id, start, end)
+        return 200, {'search_results': {
+            'page_size': 50,
+            'ids': [card['token'] for card in cards],
+        }}
+
+    @route('POST', r'/payment_methods/all/expiring\?start=(\d+)&end=(\d+)')
+    def search_expiring(self, merchant_id, body, start, end):
+        ids = body['search']['ids']
+        cards = [
+            card for card in self.search_expiring_cards(merchant_id, start, end)
+            if card['token'] in ids
+        ]
+        return 200, {'payment_methods': {'credit_card': cards}}
+
+
+class FakeBraintreeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Answer right away instead of waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle_verb(self, verb):
+        fake = self.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else ''
+        body = XmlUtil.dict_from_xml(raw_body) if raw_body.strip() else {}
+
+        for route_verb, pattern, func in ROUTES:
+            match = pattern.match(self.path)
+            if route_verb != verb or not match:
+                continue
+            merchant_id = match.group(1)
+            authorization = self.headers.get('Authorization', '')
+            with fake.lock:
+                fake.requests.append((verb, self.path))
+                if authorization != 'Basic %s' % fake.merchants.get(
+                        merchant_id):
+                    fake.auth_failures.append((merchant_id, self.path))
+                    status, response = 401, None
+                    break
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.outage_status:
+                status, response = fake.outage_status, None
+                break
+            if fake.inject_error():
+                status, response = 500, None
+                break
+            with fake.lock:
+                fault = fake.faults.popleft() if fake.faults else None
+            if fault is not None and not fault[1]:
+                status, response = fault[0], None
+                break
+            status, response = func(fake, merchant_id, body,
+                                    *match.groups()[1:])
+            if fault is not None:
+                status, response = fault[0], None
+            break
+        else:
+            status, response = 404, None
+
+        payload = XmlUtil.xml_from_dict(response) if response else ''
+        # Braintree answers blank fields as null
+        payload = re.sub(r'<([\w-]+)></\1>', r'<\1 nil="true"/>', payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.handle_verb('GET')
+
+    def do_POST(self):
+        self.handle_verb('POST')
+
+    def do_PUT(self):
+        self.handle_verb('PUT')
+
+    def do_DELETE(self):
+        self.handle_verb('DELETE')
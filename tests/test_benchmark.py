@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_benchmark.py
+
+    Benchmarks, run with `py.test tests --benchmark`
+
+    :copyright: (C) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import threading
+from decimal import Decimal
+
+import pytest
+from sql import Null
+from trytond import backend
+from trytond.transaction import Transaction
+
+
+@pytest.fixture()
+def benchmark_size(request):
+    if not request.config.getoption('--benchmark'):
+        pytest.skip('Benchmarks are only run with --benchmark')
+    return request.config.getoption('--benchmark-size')
+
+
+@pytest.fixture()
+def benchmark_calls(request, fake_braintree):
+    if not request.config.getoption('--benchmark'):
+        pytest.skip('Benchmarks are only run with --benchmark')
+    fake_braintree.latency = request.config.getoption('--benchmark-latency')
+    return request.config.getoption('--benchmark-calls')
+
+
+class DurationRecorder(object):
+    """
+    Metrics exporter keeping the duration of every Braintree call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def observe(self, key, outcome, duration):
+        with self.lock:
+            self.durations.setdefault(key[2], []).append(duration)
+
+    def __enter__(self):
+        from trytond.modules.payment_gateway_braintree.metrics import metrics
+        metrics.add_exporter(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        from trytond.modules.payment_gateway_braintree.metrics import metrics
+        self.elapsed = time.time() - self.start
+        metrics.remove_exporter(self)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def print_throughput(name, count, recorder):
+    print '\n%s: %d payments in %.2f s, %.1f payments/s' % (
+        name, count, recorder.elapsed, count / recorder.elapsed
+    )
+    for operation, durations in sorted(recorder.durations.items()):
+        print '  %-30s %5d calls  p50 %7.1f ms  p99 %7.1f ms' % (
+            operation, len(durations), percentile(durations, 50) * 1000,
+            percentile(durations, 99) * 1000,
+        )
+
+
+def explain(query):
+    cursor = Transaction().connection.cursor()
+    sql, params = query
+    if backend.name() == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+    cursor.execute('EXPLAIN ' + sql, params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def timed(query, repeat=200):
+    cursor = Transaction().connection.cursor()
+    start = time.time()
+    for _ in xrange(repeat):
+        cursor.execute(*query)
+        cursor.fetchall()
+    return (time.time() - start) / repeat
+
+
+def insert(table, columns, rows, chunk=1000):
+    cursor = Transaction().connection.cursor()
+    for index in xrange(0, len(rows), chunk):
+        cursor.execute(*table.insert(columns, rows[index:index + chunk]))
+
+
+def index_definition(index_name):
+    cursor = Transaction().connection.cursor()
+    if backend.name() == 'sqlite':
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND name = ?", (index_name,))
+    else:
+        cursor.execute(
+            'SELECT indexdef FROM pg_indexes WHERE indexname = %s',
+            (index_name,))
+    return cursor.fetchone()[0]
+
+
+def compare_plans(query, index_name, cleanup):
+    """
+    Return the plan and timing of `query` without and with the index.
+
+    DDL commits implicitly on SQLite, so there the rows generated by the
+    test are deleted by the `cleanup` query and the index is created again
+    once done, which commits the deletion. PostgreSQL rolls back both with
+    the test transaction.
+    """
+    cursor = Transaction().connection.cursor()
+    definition = index_definition(index_name)
+    cursor.execute('ANALYZE')
+    with_index = explain(query), timed(query)
+    try:
+        cursor.execute('DROP INDEX "%s"' % index_name)
+        cursor.execute('ANALYZE')
+        without_index = explain(query), timed(query)
+    finally:
+        if backend.name() == 'sqlite':
+            cursor.execute(*cleanup)
+            cursor.execute(definition)
+
+    print '\n%s' % index_name
+    print 'without index (%.3f ms)\n%s' % (
+        without_index[1] * 1000, without_index[0])
+    print 'with index (%.3f ms)\n%s' % (
+        with_index[1] * 1000, with_index[0])
+    return without_index, with_index
+
+
+class TestBenchmark:
+
+    def test_customer_id_index(self, benchmark_size, dataset, transaction):
+        """
+        Customer id lookup on a large number of payment profiles
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+
+        table = PaymentProfile.__table__()
+        customer = data.customer
+        gateway = data.braintree_gateway
+        # Only a few profiles carry a Braintree customer id
+        insert(table, [
+            table.party, table.address, table.gateway, table.sequence,
+            table.active, table.provider_reference, table.expiry_month,
+            table.expiry_year, table.braintree_customer_id,
+        ], [[
+            customer.id + index, customer.addresses[0].id, gateway.id, 10,
+            True, 'benchmark-token-%d' % index, '01', '2030',
+            'benchmark-customer-%d' % index if index % 100 == 0 else None,
+        ] for index in xrange(benchmark_size)])
+
+        query = table.select(
+            table.braintree_customer_id,
+            where=(table.party == customer.id + benchmark_size / 2) &
+            (table.gateway == gateway.id) &
+            (table.braintree_customer_id != Null),
+            limit=1
+        )
+        (plan_before, _), (plan_after, _) = compare_plans(
+            query, 'party_payment_profile_braintree_customer_index',
+            table.delete(
+                where=table.provider_reference.like('benchmark-token-%')
+            )
+        )
+        assert 'braintree_customer_index' not in plan_before
+        assert 'braintree_customer_index' in plan_after
+
+    def test_provider_reference_index(
+        self, benchmark_size, dataset, transaction
+    ):
+        """
+        Transaction lookup by provider reference on a large table
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        table = PaymentTransaction.__table__()
+        customer = data.customer
+        insert(table, [
+            table.uuid, table.type, table.state, table.date, table.party,
+            table.address, table.gateway, table.company, table.currency,
+            table.amount, table.credit_account, table.provider_reference,
+        ], [[
+            'benchmark-uuid-%d' % index, 'charge', 'posted',
+            data.company.create_date,
+            customer.id, customer.addresses[0].id,
+            data.braintree_gateway.id, data.company.id,
+            data.company.currency.id, 10, customer.account_receivable.id,
+            'ref-%d' % index if index % 10 else None,
+        ] for index in xrange(benchmark_size)])
+
+        query = table.select(
+            table.id,
+            where=(table.gateway == data.braintree_gateway.id) &
+            (table.provider_reference == 'ref-%d' % (benchmark_size / 2 + 1))
+        )
+        (plan_before, _), (plan_after, _) = compare_plans(
+            query, 'payment_gateway_transaction_provider_reference_index',
+            table.delete(where=table.uuid.like('benchmark-uuid-%'))
+        )
+        assert 'provider_reference_index' not in plan_before
+        assert 'provider_reference_index' in plan_after
+
+
+class TestThroughputBenchmark:
+    """
+    Payments per second and latency of the Braintree calls through the
+    module, against the fake Braintree server
+    """
+
+    def setup_gateway(self, data, fake_braintree):
+        gateway = data.braintree_gateway
+        fake_braintree.add_merchant(
+            gateway.braintree_merchant_id,
+            gateway.braintree_public_key,
+            gateway.braintree_api_key,
+        )
+        return gateway
+
+    def setup_profile(self, data, fake_braintree):
+        PaymentProfile = self.POOL.get('party.payment_profile')
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile, = PaymentProfile.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': 'token',
+            'braintree_customer_id': 'customer',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        }])
+        return profile
+
+    def create_transactions(self, data, profile, count):
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+
+        return PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': profile.id,
+            'gateway': profile.gateway.id,
+            'amount': Decimal(index % 1000 + 1),
+        } for index in xrange(count)])
+
+    def test_capture(
+        self, benchmark_calls, dataset, transaction, fake_braintree
+    ):
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+        profile = self.setup_profile(data, fake_braintree)
+
+        transactions = self.create_transactions(
+            data, profile, benchmark_calls
+        )
+        with DurationRecorder() as recorder:
+            PaymentTransaction.capture(transactions)
+        print_throughput('capture', benchmark_calls, recorder)
+        assert all(t.state == 'posted' for t in transactions)
+
+        transactions = self.create_transactions(
+            data, profile, benchmark_calls
+        )
+        with DurationRecorder() as recorder:
+            report = PaymentTransaction.capture_braintree_batch(transactions)
+        print_throughput('capture_braintree_batch', benchmark_calls, recorder)
+        assert report['counts'] == {'posted': benchmark_calls}
+
+    def test_settle(
+        self, benchmark_calls, dataset, transaction, fake_braintree
+    ):
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+        profile = self.setup_profile(data, fake_braintree)
+
+        transactions = self.create_transactions(
+            data, profile, benchmark_calls * 2
+        )
+        PaymentTransaction.authorize(transactions)
+        sequential = transactions[:benchmark_calls]
+        batch = transactions[benchmark_calls:]
+
+        with DurationRecorder() as recorder:
+            PaymentTransaction.settle(sequential)
+        print_throughput('settle', benchmark_calls, recorder)
+        assert all(t.state == 'posted' for t in sequential)
+
+        with DurationRecorder() as recorder:
+            report = PaymentTransaction.settle_braintree_batch(batch)
+        print_throughput('settle_braintree_batch', benchmark_calls, recorder)
+        assert report['counts'] == {'posted': benchmark_calls}
+
+    def test_refund(
+        self, benchmark_calls, dataset, transaction, fake_braintree
+    ):
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+        profile = self.setup_profile(data, fake_braintree)
+
+        transactions = self.create_transactions(
+            data, profile, benchmark_calls
+        )
+        PaymentTransaction.capture_braintree_batch(transactions)
+        # Settle half of them so both voids and refunds are measured
+        settled = transactions[::2]
+        for transaction in settled:
+            fake_braintree.transactions[transaction.provider_reference][
+                'status'] = 'settled'
+        PaymentTransaction.update_braintree_batch(transactions)
+        assert all(t.braintree_status == 'settled' for t in settled)
+        refunds = [t.create_refund() for t in transactions]
+
+        with DurationRecorder() as recorder:
+            PaymentTransaction.refund(refunds)
+        print_throughput('refund', benchmark_calls, recorder)
+        assert all(t.state == 'posted' for t in refunds)
+        # The known status picks the right call the first time
+        assert len(recorder.durations['transaction.refund']) == len(settled)
+        assert len(recorder.durations['transaction.void']) == \
+            benchmark_calls - len(settled)
+
+    def test_profile_creation(
+        self, benchmark_calls, dataset, transaction, fake_braintree
+    ):
+        ProfileWizard = self.POOL.get(
+            'party.party.payment_profile.add', type='wizard'
+        )
+        data = dataset()
+        gateway = self.setup_gateway(data, fake_braintree)
+        party = data.customer
+
+        with DurationRecorder() as recorder:
+            for index in xrange(benchmark_calls):
+                wizard = ProfileWizard(ProfileWizard.create()[0])
+                wizard.card_info.owner = party.name
+                wizard.card_info.number = '4111111111111111'
+                wizard.card_info.expiry_month = '06'
+                wizard.card_info.expiry_year = '2030'
+                wizard.card_info.csc = '123'
+                wizard.card_info.gateway = gateway
+                wizard.card_info.provider = gateway.provider
+                wizard.card_info.address = party.addresses[0]
+                wizard.card_info.party = party
+                with Transaction().set_context(return_profile=True):
+                    wizard.transition_add()
+        print_throughput('add payment profile', benchmark_calls, recorder)
+        assert len(fake_braintree.credit_cards) == benchmark_calls
@@ -5,10 +5,15 @@
     :copyright: (C) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import json
+import base64
+import socket
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
 
-import braintree
 import pytest
+from braintree.util.crypto import Crypto
 # Importing transaction directly causes cyclic dependency in 3.6
 from trytond.tools.singleton import Singleton  # noqa
 from trytond.transaction import Transaction
@@ -26,6 +31,21 @@ DUMMY_CARD = {
 }
 
 
+@contextmanager
+def braintree_config(**options):
+    """Set options of the braintree configuration section inside the block
+    """
+    if not config.has_section('braintree'):
+        config.add_section('braintree')
+    for name, value in options.iteritems():
+        config.set('braintree', name, str(value))
+    try:
+        yield
+    finally:
+        for name in options:
+            config.remove_option('braintree', name)
+
+
 class TestPaymentGateway:
 
     def create_payment_profile(self, party, gateway):
@@ -50,6 +70,48 @@ class TestPaymentGateway:
             profile = profile_wizard.transition_add()
         return profile
 
+    def setup_gateway(self, data, fake_braintree, gateway=None):
+        """Register the gateway, the Braintree gateway of the dataset by
+        default, on the fake server
+        """
+        gateway = gateway or data.braintree_gateway
+        fake_braintree.add_merchant(
+            gateway.braintree_merchant_id,
+            gateway.braintree_public_key,
+            gateway.braintree_api_key,
+        )
+        return gateway
+
+    def create_profile(self, data, gateway, **values):
+        """Create a payment profile of the customer for a card stored in the
+        vault already
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+
+        values.setdefault('provider_reference', 'token')
+        values.setdefault('braintree_customer_id', 'customer')
+        values.setdefault('expiry_month', '01')
+        values.setdefault('expiry_year', '2030')
+        profile, = PaymentProfile.create([dict({
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': gateway.id,
+        }, **values)])
+        return profile
+
+    def create_transactions(self, data, gateway, amounts, **values):
+        """Create a draft charge of the customer for each amount
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+
+        return PaymentTransaction.create([dict({
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': gateway.id,
+            'amount': Decimal(amount),
+        }, **values) for amount in amounts])
+
     def test_add_payment_profile(self, dataset, transaction):
         """Test adding payment profile to a Party
         """
@@ -373,8 +435,8 @@ class TestPaymentGateway:
         PaymentProfile = self.POOL.get('party.payment_profile')
         data = dataset()
 
-        data.braintree_gateway.configure_braintree_client()
-        customer = braintree.Customer.create({
+        client = data.braintree_gateway.get_braintree_client()
+        customer = client.customer.create({
             "first_name": "Jen",
             "last_name": "Smith",
             "company": "Braintree",
@@ -383,7 +445,7 @@ class TestPaymentGateway:
             "fax": "614.555.5678",
             "website": "www.example.com"
         }).customer
-        card = braintree.CreditCard.create({
+        card = client.credit_card.create({
             "customer_id": customer.id,
             "number": "4111111111111111",
             "expiration_date": "06/2022",
@@ -410,8 +472,8 @@ class TestPaymentGateway:
         PaymentProfile = self.POOL.get('party.payment_profile')
         data = dataset()
 
-        data.braintree_gateway.configure_braintree_client()
-        customer = braintree.Customer.create({
+        client = data.braintree_gateway.get_braintree_client()
+        customer = client.customer.create({
             "first_name": "Jen",
             "last_name": "Smith",
             "company": "Braintree",
@@ -420,7 +482,7 @@ class TestPaymentGateway:
             "fax": "614.555.5678",
             "website": "www.example.com"
         }).customer
-        card = braintree.CreditCard.create({
+        card = client.credit_card.create({
             "customer_id": customer.id,
             "number": "4111111111111111",
             "expiration_date": "06/2022",
@@ -433,7 +495,7 @@ class TestPaymentGateway:
         payment_profile = PaymentProfile(payment_profile_id)
 
         assert isinstance(payment_profile_id, int)
-        card = braintree.CreditCard.find(payment_profile.provider_reference)
+        card = client.credit_card.find(payment_profile.provider_reference)
 
         assert card.billing_address is None
 
@@ -441,10 +503,1320 @@ class TestPaymentGateway:
         payment_profile.update_braintree()
 
         # read card again
-        card = braintree.CreditCard.find(payment_profile.provider_reference)
+        card = client.credit_card.find(payment_profile.provider_reference)
         assert card.billing_address.street_address == payment_profile.address.street
         assert card.billing_address.extended_address == payment_profile.address.streetbis
         assert card.billing_address.locality == payment_profile.address.city
         assert card.billing_address.postal_code == payment_profile.address.zip
         assert card.billing_address.region == payment_profile.address.subdivision.name
         assert card.billing_address.country_code_alpha2 == payment_profile.address.country.code
+
+    def test_braintree_client_cache(self, dataset, transaction):
+        """
+        Each gateway gets its own client, reused until the gateway changes
+        """
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        data = dataset()
+
+        gateway1 = data.braintree_gateway
+        gateway2, = PaymentGateway.copy([gateway1], {
+            'braintree_merchant_id': 'second_merchant',
+        })
+
+        client1 = gateway1.get_braintree_client()
+        client2 = gateway2.get_braintree_client()
+
+        assert client1 is gateway1.get_braintree_client()
+        assert client1 is not client2
+        assert client1.config.merchant_id == 't3scq4k2ckwrxsnr'
+        assert client2.config.merchant_id == 'second_merchant'
+
+        PaymentGateway.write([gateway2], {'braintree_public_key': 'new'})
+        gateway2 = PaymentGateway(gateway2.id)
+
+        assert gateway2.get_braintree_client() is not client2
+        assert gateway2.get_braintree_client().config.public_key == 'new'
+
+    def test_concurrent_capture_across_gateways(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Fire hundreds of parallel captures against two gateways through the
+        module and make sure every charge goes out with the credentials of
+        its own gateway
+        """
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway1 = data.braintree_gateway
+        gateway2, = PaymentGateway.copy([gateway1], {
+            'braintree_merchant_id': 'merchant2',
+            'braintree_public_key': 'public2',
+            'braintree_api_key': 'private2',
+        })
+        transactions = []
+        for gateway in (gateway1, gateway2):
+            self.setup_gateway(data, fake_braintree, gateway)
+            profile = self.create_profile(
+                data, gateway, provider_reference='token-%d' % gateway.id,
+                braintree_customer_id='customer-%d' % gateway.id,
+            )
+            # The last ones are declined
+            transactions.extend(self.create_transactions(
+                data, gateway, range(1, 191) + range(2001, 2011),
+                payment_profile=profile.id
+            ))
+
+        report = PaymentTransaction.capture_braintree_batch(
+            transactions, workers=50
+        )
+
+        assert fake_braintree.auth_failures == []
+        assert report['counts'] == {'posted': 380, 'failed': 20}
+        sales = dict(
+            (sale['order_id'], sale)
+            for sale in fake_braintree.transactions.values()
+        )
+        assert len(sales) == 400
+        for txn in transactions:
+            sale = sales[txn.uuid]
+            assert sale['merchant_id'] == txn.gateway.braintree_merchant_id
+            assert Decimal(sale['amount']) == txn.amount
+            if txn.amount < 2000:
+                assert txn.state == 'posted'
+                assert txn.provider_reference == sale['id']
+                assert txn.braintree_status == 'submitted_for_settlement'
+            else:
+                assert txn.state == 'failed'
+                log, = txn.logs
+                assert json.loads(log.log)['processor_response_code'] == \
+                    sale['processor_response_code']
+
+    def test_braintree_connection_pool(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        API calls of a gateway reuse the same keep-alive connection
+        """
+        data = dataset()
+        gateway = self.setup_gateway(data, fake_braintree)
+        client = gateway.get_braintree_client()
+
+        for amount in range(1, 11):
+            result = client.transaction.sale({'amount': Decimal(amount)})
+            assert result.is_success
+            client.transaction.find(result.transaction.id)
+
+        stats = gateway.get_braintree_http_stats()
+        assert stats['requests'] == 20
+        assert stats['misses'] == 1
+        assert stats['hits'] == 19
+
+    def test_capture_braintree_batch(
+        self, dataset, transaction, fake_braintree, monkeypatch
+    ):
+        """
+        Capture many transactions concurrently and write the states back
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, [-1] + range(1, 50), payment_profile=profile.id
+        )
+        # Neither a card nor a profile to charge
+        no_card, = self.create_transactions(data, gateway, [10])
+        # Captured already
+        captured, = self.create_transactions(
+            data, gateway, [10], payment_profile=profile.id,
+            state='completed', provider_reference='captured',
+        )
+
+        report = PaymentTransaction.capture_braintree_batch(
+            transactions + [no_card, captured], workers=8
+        )
+
+        declined = transactions[0]
+        assert report['total'] == 51
+        assert report['counts'] == {'failed': 2, 'posted': 49}
+        assert report['outcomes'][declined.id] == 'failed'
+        assert report['throughput'] > 0
+        assert declined.state == 'failed'
+        assert len(declined.logs) == 1
+        for txn in transactions[1:]:
+            assert txn.state == 'posted'
+            assert txn.provider_reference in fake_braintree.transactions
+        assert no_card.state == 'failed'
+        assert len(no_card.logs) == 1
+        assert captured.state == 'completed'
+        assert captured.provider_reference == 'captured'
+        assert len(fake_braintree.transactions) == 49
+
+        # A bug building the charge data is not turned into a failed payment
+        def get_braintree_charge_data(self):
+            raise TypeError('Broken override')
+
+        draft, = PaymentTransaction.copy([transactions[1]], {
+            'state': 'draft',
+        })
+        with monkeypatch.context() as patch:
+            patch.setattr(
+                PaymentTransaction, 'get_braintree_charge_data',
+                get_braintree_charge_data
+            )
+            with pytest.raises(TypeError):
+                PaymentTransaction.capture_braintree_batch([draft])
+        assert draft.state == 'draft'
+        assert draft.logs == ()
+
+    def test_settle_braintree_batch(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Settle many authorizations concurrently, logging each failure
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, range(1, 31), payment_profile=profile.id
+        )
+        PaymentTransaction.authorize(transactions)
+        assert all(txn.state == 'authorized' for txn in transactions)
+
+        # More than the authorized amount cannot be settled
+        PaymentTransaction.write(transactions[:2], {'amount': 500})
+
+        report = PaymentTransaction.settle_braintree_batch(
+            transactions, workers=8
+        )
+
+        assert report['counts'] == {'failed': 2, 'posted': 28}
+        for txn in transactions[:2]:
+            assert txn.state == 'failed'
+            assert len(txn.logs) == 1
+        for txn in transactions[2:]:
+            assert txn.state == 'posted'
+            assert fake_braintree.transactions[txn.provider_reference][
+                'status'] == 'submitted_for_settlement'
+
+    def test_sync_braintree_transactions(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Pending transactions are updated from Braintree in bulk
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, range(1, 7), payment_profile=profile.id
+        )
+        settled, voided, declined, unchanged, final, captured = transactions
+        PaymentTransaction.authorize(transactions[:-1])
+        PaymentTransaction.capture([captured])
+        assert captured.state == 'posted'
+
+        for txn, status in [
+                (settled, 'settled'),
+                (voided, 'voided'),
+                (declined, 'processor_declined'),
+                (final, 'settled'),
+                (captured, 'settled')]:
+            fake_braintree.transactions[txn.provider_reference]['status'] = \
+                status
+        PaymentTransaction.write([final], {'state': 'cancel'})
+        del fake_braintree.requests[:]
+
+        PaymentTransaction.sync_braintree_transactions()
+
+        assert settled.state == 'posted'
+        assert voided.state == 'cancel'
+        assert declined.state == 'failed'
+        assert unchanged.state == 'authorized'
+        assert final.state == 'cancel'
+        # The status of posted charges is still followed
+        assert captured.state == 'posted'
+        assert captured.braintree_status == 'settled'
+        # One search for the ids and one page of results, no single finds
+        assert [verb for verb, path in fake_braintree.requests] == \
+            ['POST', 'POST']
+
+        # Charges posted with a final status are not synced anymore
+        del fake_braintree.requests[:]
+        report = PaymentTransaction.update_braintree_batch([captured])
+        assert report['total'] == 0
+        assert fake_braintree.requests == []
+
+    def test_braintree_webhook(self, dataset, transaction, fake_braintree):
+        """
+        Webhook notifications update the matching transaction once
+        """
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transaction1, = self.create_transactions(
+            data, gateway, [10], payment_profile=profile.id
+        )
+        PaymentTransaction.authorize([transaction1])
+        assert transaction1.state == 'authorized'
+
+        notification = gateway.get_braintree_client() \
+            .webhook_testing.sample_notification(
+                'transaction_disbursed', transaction1.provider_reference
+            )
+
+        result = PaymentGateway.braintree_webhook(
+            gateway.id, notification['bt_signature'],
+            notification['bt_payload']
+        )
+        assert result == {'kind': 'transaction_disbursed', 'updated': 1}
+        assert transaction1.state == 'posted'
+
+        # Deliveries are retried by Braintree, the second one is a no-op
+        result = PaymentGateway.braintree_webhook(
+            gateway.id, notification['bt_signature'],
+            notification['bt_payload']
+        )
+        assert result == {'kind': 'transaction_disbursed', 'updated': 0}
+        assert transaction1.state == 'posted'
+
+        # The settlement of the posted charge was declined afterwards, the
+        # library has no sample of this notification
+        payload = base64.encodestring(
+            '<notification>'
+            '<timestamp type="datetime">2016-01-01T00:00:00Z</timestamp>'
+            '<kind>transaction_settlement_declined</kind>'
+            '<subject><transaction><id>%s</id>'
+            '<amount>10</amount><tax-amount nil="true"/>'
+            '<status>settlement_declined</status>'
+            '</transaction></subject>'
+            '</notification>' % transaction1.provider_reference
+        )
+        signature = '%s|%s' % (
+            gateway.braintree_public_key,
+            Crypto.sha1_hmac_hash(gateway.braintree_api_key, payload)
+        )
+        for _ in range(2):
+            result = PaymentGateway.braintree_webhook(
+                gateway.id, signature, payload
+            )
+            assert result == {
+                'kind': 'transaction_settlement_declined', 'updated': 0,
+            }
+        assert transaction1.state == 'posted'
+        assert transaction1.braintree_status == 'settlement_declined'
+        log, = [
+            log for log in transaction1.logs
+            if 'settlement_declined' in log.log
+        ]
+        assert json.loads(log.log)['status'] == 'settlement_declined'
+        assert PaymentTransaction.search(
+            PaymentTransaction.get_braintree_posted_declined_domain()
+        ) == [transaction1]
+
+        # Without webhooks the declined settlement is found by the sync
+        transaction2, = self.create_transactions(
+            data, gateway, [20], payment_profile=profile.id
+        )
+        PaymentTransaction.capture([transaction2])
+        assert transaction2.state == 'posted'
+        fake_braintree.transactions[transaction2.provider_reference][
+            'status'] = 'settlement_declined'
+        for _ in range(2):
+            PaymentTransaction.sync_braintree_transactions()
+        assert transaction2.state == 'posted'
+        assert transaction2.braintree_status == 'settlement_declined'
+        assert len([
+            entry for entry in transaction2.logs
+            if 'settlement_declined' in entry.log
+        ]) == 1
+        assert set(PaymentTransaction.search(
+            PaymentTransaction.get_braintree_posted_declined_domain()
+        )) == set([transaction1, transaction2])
+
+        with pytest.raises(UserError):
+            PaymentGateway.braintree_webhook(
+                gateway.id, 'tampered|signature', notification['bt_payload']
+            )
+
+    def test_braintree_customer_id_cache(
+        self, dataset, transaction, monkeypatch
+    ):
+        """
+        The customer id of a party is looked up once per gateway
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+
+        party, gateway = data.customer, data.braintree_gateway
+        assert party._get_braintree_customer_id(gateway) is None
+
+        profile, = PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': 'token',
+            'braintree_customer_id': 'customer1',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        }])
+        assert party._get_braintree_customer_id(gateway) == 'customer1'
+
+        def search(*args, **kwargs):
+            raise AssertionError('Customer id should be cached')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(PaymentProfile, 'search', staticmethod(search))
+            assert party._get_braintree_customer_id(gateway) == 'customer1'
+
+            # Writing other fields keeps the cache
+            PaymentProfile.write([profile], {
+                'expiry_year': '2031',
+                'braintree_sync_digest': 'digest',
+            })
+            assert party._get_braintree_customer_id(gateway) == 'customer1'
+
+        PaymentProfile.write([profile], {
+            'braintree_customer_id': 'customer2',
+        })
+        assert party._get_braintree_customer_id(gateway) == 'customer2'
+
+        PaymentProfile.delete([profile])
+        assert party._get_braintree_customer_id(gateway) is None
+
+        # Ids read in a transaction which is rolled back are forgotten
+        PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': 'token',
+            'braintree_customer_id': 'customer3',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        }])
+        assert party._get_braintree_customer_id(gateway) == 'customer3'
+        Transaction().rollback()
+        assert party._get_braintree_customer_id(gateway) is None
+
+    def test_refund_uses_known_status(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Refunds choose between void and refund from the status last seen
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        voided, refunded, stale, unsettled = self.create_transactions(
+            data, gateway, [10] * 4, payment_profile=profile.id
+        )
+        PaymentTransaction.capture([voided, refunded, stale, unsettled])
+        for txn in (voided, refunded, stale, unsettled):
+            assert txn.state == 'posted'
+            assert txn.braintree_status == 'submitted_for_settlement'
+            assert txn.braintree_status_date
+
+        # Settled before Braintree told us so: the void is refused and the
+        # transaction is refunded instead
+        fake_braintree.transactions[refunded.provider_reference]['status'] = \
+            'settled'
+        # A status which could have changed since it was seen is not looked
+        # up, the transaction is refunded, or voided if it is not settled
+        fake_braintree.transactions[stale.provider_reference]['status'] = \
+            'settled'
+        PaymentTransaction.write([stale, unsettled], {
+            'braintree_status_date': datetime.now() - timedelta(days=1),
+        })
+        del fake_braintree.requests[:]
+
+        refunds = [
+            txn.create_refund()
+            for txn in (voided, refunded, stale, unsettled)
+        ]
+        PaymentTransaction.refund(refunds)
+
+        assert [refund.state for refund in refunds] == ['posted'] * 4
+        assert fake_braintree.requests == [
+            ('PUT', '/merchants/%s/transactions/%s/void' % (
+                gateway.braintree_merchant_id, voided.provider_reference)),
+            ('PUT', '/merchants/%s/transactions/%s/void' % (
+                gateway.braintree_merchant_id, refunded.provider_reference)),
+            ('POST', '/merchants/%s/transactions/%s/refund' % (
+                gateway.braintree_merchant_id, refunded.provider_reference)),
+            ('POST', '/merchants/%s/transactions/%s/refund' % (
+                gateway.braintree_merchant_id, stale.provider_reference)),
+            ('POST', '/merchants/%s/transactions/%s/refund' % (
+                gateway.braintree_merchant_id, unsettled.provider_reference)),
+            ('PUT', '/merchants/%s/transactions/%s/void' % (
+                gateway.braintree_merchant_id, unsettled.provider_reference)),
+        ]
+        assert voided.braintree_status == 'voided'
+        assert refunds[0].provider_reference == voided.provider_reference
+        assert refunded.braintree_status == 'submitted_for_settlement'
+        assert refunds[2].braintree_status == 'submitted_for_settlement'
+        assert unsettled.braintree_status == 'voided'
+
+    def test_braintree_logs_buffered(
+        self, dataset, transaction, fake_braintree, monkeypatch
+    ):
+        """
+        Failures of a batch are logged with one query as structured data
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        TransactionLog = self.POOL.get('payment_gateway.transaction.log')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, [-1, -2, -3, 4], payment_profile=profile.id
+        )
+
+        calls = []
+        create = TransactionLog.create
+
+        def counting_create(vlist):
+            calls.append(len(vlist))
+            return create(vlist)
+
+        monkeypatch.setattr(
+            TransactionLog, 'create', staticmethod(counting_create)
+        )
+        PaymentTransaction.capture(transactions)
+
+        assert calls == [3]
+        for txn in transactions[:3]:
+            assert txn.state == 'failed'
+            log, = txn.logs
+            assert log.is_system_generated
+            assert json.loads(log.log) == {
+                'message': 'Amount must be greater than zero.',
+                'errors': [{'code': '81502', 'path': 'transaction.amount'}],
+            }
+        assert transactions[3].state == 'posted'
+
+    def test_braintree_circuit_breaker(
+        self, dataset, transaction, fake_braintree, monkeypatch
+    ):
+        """
+        Calls fail fast while Braintree is down and resume once it is back
+        """
+        from trytond.modules.payment_gateway_braintree.client import \
+            CircuitBreaker
+
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        # Start from fresh breakers, gateway ids are reused between tests
+        monkeypatch.setattr(CircuitBreaker, '_registry', {})
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, [10] * 16, payment_profile=profile.id
+        )
+        breaker = gateway.get_braintree_circuit_breaker()
+        assert breaker.state == 'closed'
+
+        fake_braintree.outage_status = 503
+        with braintree_config(retry_attempts=1):
+            PaymentTransaction.capture(transactions[:15])
+
+        # The breaker opened after 10 failed calls, the next ones were not
+        # sent at all
+        assert len(fake_braintree.requests) == 10
+        assert breaker.state == 'open'
+        assert breaker.stats()['rejected'] == 5
+        for txn in transactions[:15]:
+            assert txn.state == 'failed'
+        assert json.loads(transactions[14].logs[0].log)['exception'] == \
+            'GatewayUnavailableError'
+
+        # Braintree is back, a probe is allowed once the reset timeout
+        # elapsed and closes the circuit
+        fake_braintree.outage_status = None
+        breaker._opened_at -= breaker.reset_timeout
+        assert breaker.state == 'half-open'
+        PaymentTransaction.capture(transactions[15:])
+        assert transactions[15].state == 'posted'
+        assert breaker.state == 'closed'
+        assert gateway.get_braintree_http_stats()['circuit_breaker'] == {
+            'state': 'closed', 'trips': 1, 'rejected': 5,
+        }
+
+    def test_braintree_retry(self, dataset, transaction, fake_braintree):
+        """
+        Transient errors are retried without ever charging twice
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        lost, refused, down, adopted = self.create_transactions(
+            data, gateway, [10] * 4, payment_profile=profile.id
+        )
+        # The uuid is the order id, it must not be shared
+        assert len(set(t.uuid for t in (lost, refused, down, adopted))) == 4
+
+        def sales(transaction):
+            return [
+                txn for txn in fake_braintree.transactions.values()
+                if txn['order_id'] == transaction.uuid
+            ]
+
+        # Retry at once, and keep the circuit breaker out of the way
+        with braintree_config(retry_backoff=0, breaker_window=0):
+            # The sale went through but the response was lost: it is found
+            # by its order id instead of being made again
+            fake_braintree.faults.append((503, True))
+            PaymentTransaction.capture([lost])
+            assert lost.state == 'posted'
+            sale, = sales(lost)
+            assert lost.provider_reference == sale['id']
+
+            # The sale was refused, it is made again
+            fake_braintree.faults.append((503, False))
+            PaymentTransaction.capture([refused])
+            assert refused.state == 'posted'
+            assert len(sales(refused)) == 1
+
+            # Still failing after the last attempt
+            fake_braintree.faults.extend([(503, False)] * 3)
+            PaymentTransaction.capture([down])
+            assert down.state == 'failed'
+            assert not sales(down)
+
+            # Failing although Braintree processed the sale
+            fake_braintree.faults.extend([(500, True)] * 3)
+            PaymentTransaction.capture([adopted])
+            assert adopted.state == 'failed'
+            assert len(sales(adopted)) == 1
+            del fake_braintree.requests[:]
+
+            PaymentTransaction.retry([down, adopted])
+
+        assert down.state == 'posted'
+        assert len(sales(down)) == 1
+        assert adopted.state == 'posted'
+        sale, = sales(adopted)
+        assert adopted.provider_reference == sale['id']
+        # Only the charge which was not found is made again
+        assert [
+            path for verb, path in fake_braintree.requests
+            if path.endswith('/transactions')
+        ] == ['/merchants/%s/transactions' % gateway.braintree_merchant_id]
+
+    def test_braintree_retry_authorization(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        A failed authorization is retried as an authorization
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        authorization, = self.create_transactions(
+            data, gateway, [10], payment_profile=profile.id
+        )
+
+        with braintree_config(retry_backoff=0, breaker_window=0):
+            fake_braintree.faults.extend([(503, False)] * 3)
+            PaymentTransaction.authorize([authorization])
+            assert authorization.state == 'failed'
+            assert authorization.braintree_operation == 'authorize'
+
+            PaymentTransaction.retry([authorization])
+
+        assert authorization.state == 'authorized'
+        sale = fake_braintree.transactions[authorization.provider_reference]
+        assert sale['status'] == 'authorized'
+
+    def test_braintree_metrics(self, dataset, transaction, fake_braintree):
+        """
+        Every API call is timed and counted by gateway and operation
+        """
+        from trytond.modules.payment_gateway_braintree.metrics import \
+            metrics, StatsdExporter
+
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, [-1, 1, 2], payment_profile=profile.id
+        )
+
+        statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        statsd.bind(('127.0.0.1', 0))
+        statsd.settimeout(5)
+        exporter = StatsdExporter.get('127.0.0.1', statsd.getsockname()[1])
+        assert StatsdExporter.get(
+            '127.0.0.1', statsd.getsockname()[1]
+        ) is exporter
+        metrics.clear()
+        metrics.add_exporter(exporter)
+        try:
+            PaymentTransaction.capture(transactions)
+            with pytest.raises(Exception):
+                gateway.get_braintree_client().transaction.find('missing')
+        finally:
+            metrics.remove_exporter(exporter)
+
+        readings = dict(
+            (reading['operation'], reading)
+            for reading in PaymentGateway.get_braintree_metrics()
+            if reading['gateway'] == gateway.id
+        )
+        sale = readings['transaction.sale']
+        assert sale['count'] == 3
+        assert sale['outcomes'] == {'success': 2, 'decline': 1, 'error': 0}
+        assert sale['in_flight'] == 0
+        assert sale['buckets'][-1] == (None, 3)
+        assert readings['transaction.find']['outcomes']['error'] == 1
+
+        text = PaymentGateway.get_braintree_metrics_prometheus()
+        assert (
+            'braintree_api_calls_total{database="%s",gateway="%s",'
+            'operation="transaction.sale",outcome="decline"} 1' % (
+                self.DB_NAME, gateway.id
+            )
+        ) in text.splitlines()
+        assert 'le="+Inf"} 3' in text
+
+        payload = statsd.recv(1024)
+        assert payload.startswith(
+            'braintree.%s.%s.transaction.sale.duration:' % (
+                self.DB_NAME, gateway.id
+            )
+        )
+        statsd.close()
+
+    def test_add_payment_profile_single_call(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        The card of a new customer is stored with the customer in one call
+        """
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        merchant_path = '/merchants/%s' % gateway.braintree_merchant_id
+
+        profile1 = self.create_payment_profile(data.customer, gateway)
+        assert fake_braintree.requests == [
+            ('POST', merchant_path + '/customers'),
+        ]
+        customer = fake_braintree.customers[profile1.braintree_customer_id]
+        card, = customer['credit_cards']
+        assert profile1.provider_reference == card['token']
+        assert card['billing_address']['postal_code'] == \
+            data.customer.addresses[0].zip
+
+        # Existing customers only get a new card
+        del fake_braintree.requests[:]
+        profile2 = self.create_payment_profile(data.customer, gateway)
+        assert fake_braintree.requests == [
+            ('POST', merchant_path + '/payment_methods'),
+        ]
+        assert profile2.braintree_customer_id == \
+            profile1.braintree_customer_id
+        assert len(customer['credit_cards']) == 2
+
+    def test_capture_store_in_vault(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Charging a card with store_in_vault saves it as a payment profile
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        UseCardView = self.POOL.get('payment_gateway.transaction.use_card.view')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        merchant_path = '/merchants/%s' % gateway.braintree_merchant_id
+
+        def card_info():
+            return UseCardView(
+                number=DUMMY_CARD['number'],
+                expiry_month=DUMMY_CARD['exp_month'],
+                expiry_year=DUMMY_CARD['exp_year'],
+                csc=DUMMY_CARD['csc'],
+                owner=data.customer.name,
+            )
+
+        transaction1, transaction2 = self.create_transactions(
+            data, gateway, (100, 101)
+        )
+
+        # A new customer is created along with the card
+        transaction1.capture_braintree(
+            card_info=card_info(), store_in_vault=True
+        )
+        assert fake_braintree.requests == [
+            ('POST', merchant_path + '/transactions'),
+        ]
+        assert transaction1.state == 'posted'
+        profile1 = transaction1.payment_profile
+        assert profile1.party == data.customer
+        assert profile1.last_4_digits == DUMMY_CARD['number'][-4:]
+        assert profile1.expiry_month == DUMMY_CARD['exp_month']
+        assert profile1.expiry_year == DUMMY_CARD['exp_year']
+        customer = fake_braintree.customers[profile1.braintree_customer_id]
+        card, = customer['credit_cards']
+        assert profile1.provider_reference == card['token']
+
+        # Further cards go to the existing customer
+        transaction2.authorize_braintree(
+            card_info=card_info(), store_in_vault=True
+        )
+        assert transaction2.state == 'authorized'
+        profile2 = transaction2.payment_profile
+        assert profile2 != profile1
+        assert profile2.braintree_customer_id == \
+            profile1.braintree_customer_id
+        assert len(customer['credit_cards']) == 2
+
+        # The saved card can be charged again
+        transaction3, = self.create_transactions(
+            data, gateway, [102], payment_profile=profile1.id
+        )
+        PaymentTransaction.capture([transaction3])
+        assert transaction3.state == 'posted'
+
+    def test_braintree_authorization_crons(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Settle recent authorizations and void the stale ones
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, (100, 101, 102, 103), payment_profile=profile.id
+        )
+        PaymentTransaction.authorize(transactions)
+        recent1, recent2, stale, settled = transactions
+        assert all(t.state == 'authorized' for t in transactions)
+
+        # Authorized ten days ago, one was settled since on Braintree
+        table = PaymentTransaction.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+            [table.create_date], [datetime.now() - timedelta(days=10)],
+            where=table.id.in_([stale.id, settled.id])
+        ))
+        fake_braintree.transactions[settled.provider_reference]['status'] = \
+            'settled'
+
+        with braintree_config(auto_settle_delay=3600):
+            stats = PaymentTransaction.auto_settle_braintree(commit=False)
+            assert stats['total'] == 0
+            assert recent1.state == 'authorized'
+
+        with braintree_config(auto_settle_delay=0, batch_chunk_size=1):
+            stats = PaymentTransaction.void_stale_braintree(commit=False)
+            assert stats['total'] == 2
+            assert stats['counts'] == {'cancel': 1, 'authorized': 1}
+            assert stale.state == 'cancel'
+            assert fake_braintree.transactions[
+                stale.provider_reference]['status'] == 'voided'
+            assert settled.state == 'authorized'
+            assert len(settled.logs) == 1
+
+            stats = PaymentTransaction.auto_settle_braintree(commit=False)
+            assert stats['total'] == 2
+            assert stats['counts'] == {'posted': 2}
+            assert recent1.state == recent2.state == 'posted'
+            assert settled.state == 'authorized'
+
+    def test_braintree_capture_queue(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Deferred captures are queued and made by the queue workers
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Queue = self.POOL.get('payment_gateway.transaction.braintree_queue')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, (100, 2001, 101, 102), payment_profile=profile.id
+        )
+        captured, declined, queued, charged = transactions
+        # Neither a card nor a profile to charge
+        no_card, = self.create_transactions(data, gateway, [103])
+
+        with braintree_config(deferred_capture=True):
+            PaymentTransaction.capture([captured, declined, queued, no_card])
+        assert fake_braintree.requests == []
+        assert all(t.state == 'in-progress' for t in transactions[:3])
+        assert len(Queue.search([('state', '=', 'pending')])) == 4
+
+        # Successive claims never return the same entries
+        first = Queue.claim(2)
+        second = Queue.claim(3)
+        assert len(first) == len(second) == 2
+        assert set(first).isdisjoint(second)
+        assert all(e.state == 'processing' for e in first + second)
+        assert Queue.claim(1) == []
+        Queue.write(first + second, {'state': 'pending', 'attempts': 0})
+
+        # A worker died after charging a queued transaction
+        charged.capture_braintree(deferred=True)
+        entry, = Queue.search([('transaction', '=', charged.id)])
+        Queue.write([entry], {'state': 'processing', 'attempts': 1})
+        client = gateway.get_braintree_client()
+        charge_data = charged.get_braintree_charge_data()
+        client.transaction.sale(charge_data)
+        table = Queue.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+            [table.write_date], [datetime.now() - timedelta(hours=1)],
+            where=table.id == entry.id
+        ))
+
+        del fake_braintree.requests[:]
+        stats = Queue.process(workers=2, commit=False)
+
+        assert stats['total'] == 5
+        assert stats['counts'] == {'posted': 3, 'failed': 2}
+        assert captured.state == queued.state == charged.state == 'posted'
+        assert declined.state == no_card.state == 'failed'
+        assert len(no_card.logs) == 1
+        assert Queue.search([]) == []
+        # The stalled capture was found instead of being charged again
+        sales = [
+            t for t in fake_braintree.transactions.values()
+            if t['order_id'] == charged.uuid
+        ]
+        assert len(sales) == 1
+        assert charged.provider_reference == sales[0]['id']
+
+    def test_braintree_reconciliation(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Report the differences between Braintree and the local transactions
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Reconciliation = self.POOL.get(
+            'payment_gateway.braintree.reconciliation'
+        )
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        profile = self.create_profile(data, gateway)
+        transactions = self.create_transactions(
+            data, gateway, (100, 101, 102, 103, 104),
+            payment_profile=profile.id
+        )
+        matching, wrong_amount, wrong_state, _, missing = transactions
+        PaymentTransaction.capture(transactions[:2])
+        PaymentTransaction.authorize(transactions[2:4])
+        # The last one was never sent to Braintree
+        PaymentTransaction.write([missing], {
+            'state': 'completed', 'provider_reference': 'unknown',
+        })
+        fake_braintree.transactions[
+            wrong_amount.provider_reference]['amount'] = '99.00'
+        fake_braintree.transactions[
+            wrong_state.provider_reference]['status'] = 'settled'
+        # A sale made by another system
+        unknown = gateway.get_braintree_client().transaction.sale({
+            'amount': '42.00', 'payment_method_token': 'token',
+        }).transaction
+
+        with braintree_config(reconcile_window=3600, batch_chunk_size=2):
+            reconciliation, = Reconciliation.create([{
+                'gateway': gateway.id,
+                'start': datetime.utcnow() - timedelta(days=1),
+                'end': datetime.utcnow() + timedelta(minutes=1),
+            }])
+            Reconciliation.reconcile([reconciliation])
+
+        assert reconciliation.state == 'done'
+        assert reconciliation.braintree_count == 5
+        mismatches = sorted(
+            (line.kind, line.provider_reference, line.transaction)
+            for line in reconciliation.lines
+        )
+        assert mismatches == sorted([
+            ('amount', wrong_amount.provider_reference, wrong_amount),
+            ('state', wrong_state.provider_reference, wrong_state),
+            ('missing_local', unknown.id, None),
+            ('missing_braintree', 'unknown', missing),
+        ])
+        line, = [
+            line for line in reconciliation.lines if line.kind == 'amount'
+        ]
+        assert line.local_amount == Decimal('101')
+        assert line.braintree_amount == Decimal('99')
+
+    def test_braintree_charge_data_batch(
+        self, dataset, transaction, monkeypatch
+    ):
+        """
+        Build the charge data of many transactions with bulk lookups
+        """
+        Party = self.POOL.get('party.party')
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        gateway = data.braintree_gateway
+        other, = Party.create([{
+            'name': 'Other Customer',
+            'addresses': [('create', [{'name': 'Other Customer'}])],
+        }])
+        profiles = PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': 'token-%s' % party.id,
+            'braintree_customer_id': customer_id,
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        } for party, customer_id in [
+            (data.customer, 'customer1'), (other, None),
+        ]])
+        transactions = PaymentTransaction.create([{
+            'party': profile.party.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': profile.address.id,
+            'payment_profile': profile.id,
+            'gateway': gateway.id,
+            'amount': amount,
+        } for amount in range(1, 5) for profile in profiles])
+
+        expected = [t.get_braintree_charge_data() for t in transactions]
+        assert expected[1]['customer']['company'] == 'Other Customer'
+
+        Party._get_braintree_customer_id_cache().clear()
+        searches = []
+        search = PaymentProfile.search
+
+        def counting_search(*args, **kwargs):
+            searches.append(args)
+            return search(*args, **kwargs)
+
+        with monkeypatch.context() as patch:
+            patch.setattr(
+                PaymentProfile, 'search', staticmethod(counting_search)
+            )
+            charge_data = PaymentTransaction.get_braintree_charge_data_batch(
+                transactions
+            )
+        assert charge_data == expected
+        assert len(searches) == 1
+
+    def test_braintree_vault_import(
+        self, dataset, transaction, fake_braintree, monkeypatch
+    ):
+        """
+        Import the cards of the Braintree vault as payment profiles
+        """
+        ContactMechanism = self.POOL.get('party.contact_mechanism')
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        VaultImport = self.POOL.get('payment_gateway.braintree.vault_import')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        party = data.customer
+        ContactMechanism.create([{
+            'party': party.id,
+            'type': 'email',
+            'value': 'john@example.com',
+        }])
+
+        client = gateway.get_braintree_client()
+        customers = []
+        for email, days in [
+                ('John@Example.com', 10), ('jane@example.com', 5),
+                ('john@example.com', 0)]:
+            customer = client.customer.create({
+                'email': email,
+                'credit_card': {
+                    'number': DUMMY_CARD['number'],
+                    'expiration_month': DUMMY_CARD['exp_month'],
+                    'expiration_year': DUMMY_CARD['exp_year'],
+                },
+            }).customer
+            fake_braintree.customers[customer.id]['created_at'] -= \
+                timedelta(days=days)
+            customers.append(customer)
+        client.credit_card.create({
+            'customer_id': customers[0].id,
+            'number': '4111111111111111',
+            'expiration_month': '12',
+            'expiration_year': '2030',
+        })
+        # The card of the latest customer was imported already
+        imported_token = customers[2].credit_cards[0].token
+        PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': imported_token,
+            'braintree_customer_id': customers[2].id,
+            'expiry_month': '07',
+            'expiry_year': '2019',
+        }])
+
+        with braintree_config(vault_import_window=86400, batch_chunk_size=1):
+            vault_import, resumed = VaultImport.create([{
+                'gateway': gateway.id,
+                'start': datetime.utcnow() - timedelta(days=20),
+            }, {
+                'gateway': gateway.id,
+            }])
+            vault_import.import_braintree_vault(commit=False)
+
+            # An import interrupted a week ago resumes from its checkpoint
+            VaultImport.write([resumed], {
+                'checkpoint': datetime.utcnow() - timedelta(days=7),
+            })
+            resumed.import_braintree_vault(commit=False)
+
+        assert vault_import.state == 'done'
+        assert vault_import.checkpoint is not None
+        assert vault_import.customer_count == 3
+        assert vault_import.profile_count == 2
+        assert vault_import.unmatched_count == 1
+        profiles = PaymentProfile.search([
+            ('party', '=', party.id),
+            ('braintree_customer_id', '=', customers[0].id),
+        ])
+        assert sorted(p.last_4_digits for p in profiles) == ['1111', '4242']
+        assert len(PaymentProfile.search([
+            ('provider_reference', '=', imported_token),
+        ])) == 1
+
+        assert resumed.state == 'done'
+        assert resumed.customer_count == 2
+        assert resumed.profile_count == 0
+
+        # An import interrupted in the middle of a window counts the
+        # customers of the window once when resumed
+        interrupted, = VaultImport.create([{
+            'gateway': gateway.id,
+            'start': datetime.utcnow() - timedelta(days=20),
+        }])
+        import_customers = VaultImport._import_braintree_customers
+        calls = []
+
+        def failing_import(self, customers):
+            calls.append(customers)
+            if len(calls) == 2:
+                raise IOError('Connection reset')
+            return import_customers(self, customers)
+
+        with braintree_config(batch_chunk_size=1):
+            with monkeypatch.context() as patch:
+                patch.setattr(
+                    VaultImport, '_import_braintree_customers', failing_import
+                )
+                with pytest.raises(IOError):
+                    interrupted.import_braintree_vault(commit=False)
+            assert interrupted.checkpoint is None
+            assert interrupted.customer_count == 0
+            interrupted.import_braintree_vault(commit=False)
+        assert interrupted.state == 'done'
+        assert interrupted.customer_count == 3
+        assert interrupted.unmatched_count == 1
+
+    def test_create_profiles_using_braintree_tokens(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Create the profiles of many tokens, reporting the invalid ones
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        client = gateway.get_braintree_client()
+        customer = client.customer.create({'email': 'john@example.com'})
+        tokens = [client.credit_card.create({
+            'customer_id': customer.customer.id,
+            'number': number,
+            'expiration_month': '12',
+            'expiration_year': '2030',
+            'cardholder_name': 'John Doe',
+        }).credit_card.token for number in (
+            '4111111111111111', '4242424242424242', '5555555555554444',
+        )]
+        tokens.insert(1, 'unknown')
+
+        results = PaymentProfile.create_profiles_using_braintree_tokens(
+            data.customer.id, gateway.id, tokens, workers=2
+        )
+
+        assert [r['token'] for r in results] == tokens
+        assert 'profile' not in results[1]
+        assert results[1]['error']
+        profiles = PaymentProfile.browse(
+            [r['profile'] for r in results if 'profile' in r]
+        )
+        assert [p.provider_reference for p in profiles] == \
+            tokens[:1] + tokens[2:]
+        assert [p.last_4_digits for p in profiles] == \
+            ['1111', '4242', '4444']
+        assert all(
+            p.braintree_customer_id == customer.customer.id and
+            p.party == data.customer for p in profiles
+        )
+
+    def test_update_braintree_batch(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Push only the changed profiles to Braintree, at a limited rate
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        client = gateway.get_braintree_client()
+        customer = client.customer.create({'email': 'john@example.com'})
+        tokens = [client.credit_card.create({
+            'customer_id': customer.customer.id,
+            'number': '4111111111111111',
+            'expiration_month': '12',
+            'expiration_year': '2030',
+        }).credit_card.token for _ in range(4)] + ['unknown']
+        profiles = PaymentProfile.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': token,
+            'braintree_customer_id': customer.customer.id,
+            'expiry_month': '01',
+            'expiry_year': '2031',
+        } for token in tokens])
+
+        with braintree_config(update_rate_limit=20):
+            del fake_braintree.requests[:]
+            report = PaymentProfile.update_braintree_batch(
+                profiles, workers=4
+            )
+            assert report['counts'] == {'updated': 4, 'failed': 1}
+            assert report['errors'] == {'NotFoundError': [profiles[-1].id]}
+            assert len(fake_braintree.requests) == 5
+            # 5 calls at 20 per second
+            assert report['elapsed'] >= 0.2
+            for token in tokens[:-1]:
+                card = fake_braintree.credit_cards[token]
+                assert card['expiration_month'] == '01'
+                assert card['expiration_year'] == '2031'
+                assert card['billing_address']['postal_code'] == \
+                    data.customer.addresses[0].zip
+
+            # Only the changed profile and the failed one are sent again
+            PaymentProfile.write([profiles[0]], {'expiry_year': '2032'})
+            del fake_braintree.requests[:]
+            report = PaymentProfile.update_braintree_batch(profiles)
+            assert report['counts'] == {
+                'updated': 1, 'unchanged': 3, 'failed': 1,
+            }
+            assert len(fake_braintree.requests) == 2
+            assert fake_braintree.credit_cards[tokens[0]][
+                'expiration_year'] == '2032'
+
+    def test_sync_braintree_expiring_cards(
+        self, dataset, transaction, fake_braintree
+    ):
+        """
+        Renewed cards are updated, expired and removed ones flagged and no
+        longer charged
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Queue = self.POOL.get('payment_gateway.transaction.braintree_queue')
+        data = dataset()
+
+        gateway = self.setup_gateway(data, fake_braintree)
+        today = datetime.today()
+        last_month = today.replace(day=1) - timedelta(days=1)
+        client = gateway.get_braintree_client()
+        customer = client.customer.create({'email': 'john@example.com'})
+        tokens = [client.credit_card.create({
+            'customer_id': customer.customer.id,
+            'number': '4111111111111111',
+            'expiration_month': '%02d' % expiry.month,
+            'expiration_year': str(expiry.year),
+        }).credit_card.token for expiry in (today, last_month, today)]
+        tokens.append('removed')
+        profiles = PaymentProfile.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': token,
+            'braintree_customer_id': customer.customer.id,
+            'last_4_digits': '1111',
+            'expiry_month': '%02d' % expiry.month,
+            'expiry_year': str(expiry.year),
+        } for token, expiry in zip(
+            tokens, (today, last_month, today, today)
+        )])
+        renewed, expired, unchanged, removed = profiles
+
+        # The account updater renewed the first card and the second expired
+        fake_braintree.credit_cards[tokens[0]].update({
+            'last_4': '4444',
+            'expiration_month': '02',
+            'expiration_year': str(today.year + 3),
+        })
+        fake_braintree.credit_cards[tokens[1]]['expired'] = True
+
+        stats = PaymentProfile.sync_braintree_expiring_cards()
+
+        assert stats == {'updated': 1, 'expired': 2}
+        assert renewed.last_4_digits == '4444'
+        assert renewed.expiry_month == '02'
+        assert renewed.expiry_year == str(today.year + 3)
+        assert not renewed.braintree_expired
+        assert expired.braintree_expired
+        assert removed.braintree_expired
+        assert not unchanged.braintree_expired
+
+        # Charges against the flagged profiles fail without calling
+        # Braintree, deferred ones are not queued
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': profile.id,
+            'gateway': gateway.id,
+            'amount': 100,
+        } for profile in (expired, removed, removed)])
+        del fake_braintree.requests[:]
+        transactions[0].capture_braintree()
+        transactions[1].capture_braintree(deferred=True)
+        PaymentTransaction.capture_braintree_batch(transactions[2:])
+
+        assert fake_braintree.requests == []
+        assert all(t.state == 'failed' for t in transactions)
+        assert Queue.search([]) == []
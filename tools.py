@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+    tools.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+from trytond.transaction import Transaction
+
+__all__ = ['add_partial_index']
+
+
+def add_partial_index(table, index_name, columns, where):
+    """
+    Create a partial index on the table handled by the `TableHandler`
+    `table` unless it exists already. Both PostgreSQL and SQLite support
+    the syntax.
+
+    :param columns: List of the indexed column names
+    :param where: SQL condition of the rows to index
+    """
+    if index_name in table._indexes:
+        return
+    cursor = Transaction().connection.cursor()
+    cursor.execute(
+        'CREATE INDEX "%s" ON "%s" (%s) WHERE %s' % (
+            index_name, table.table_name,
+            ', '.join('"%s"' % column for column in columns), where,
+        )
+    )
+    table._update_definitions(indexes=True)
@@ -5,20 +5,84 @@
     :copyright: (c) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import json
+import logging
+import threading
+import warnings
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import partial
+
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, Not
-from trytond.model import fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.exceptions import UserError
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+from trytond import backend
 
 import braintree
+from braintree.error_codes import ErrorCodes
 from braintree.exceptions.braintree_error import BraintreeError
 
+from client import (
+    PooledHttp, CircuitBreaker, ExpiredCardError, call_with_retry
+)
+from batch import map_concurrently, failing, BatchReport
+from tools import add_partial_index
+from metrics import (
+    metrics, InstrumentedClient, PrometheusExporter, StatsdExporter
+)
+
 __metaclass__ = PoolMeta
 __all__ = [
     'PaymentGatewayBraintree', 'PaymentTransactionBraintree',
-    'AddPaymentProfile', 'TransactionLog'
+    'AddPaymentProfile', 'TransactionLog', 'BraintreeCaptureQueue',
 ]
 
+logger = logging.getLogger(__name__)
+
+# Local state of a transaction for each Braintree transaction status
+BRAINTREE_STATES = {
+    'authorizing': 'in-progress',
+    'authorized': 'authorized',
+    'submitted_for_settlement': 'completed',
+    'settlement_pending': 'completed',
+    'settling': 'completed',
+    'settled': 'completed',
+    'settlement_confirmed': 'completed',
+    'voided': 'cancel',
+    'authorization_expired': 'cancel',
+    'processor_declined': 'failed',
+    'gateway_rejected': 'failed',
+    'settlement_declined': 'failed',
+    'failed': 'failed',
+}
+
+# Local states which can still change on Braintree's side. The status of
+# posted charges can still change too until it is final, but not their state.
+BRAINTREE_PENDING_STATES = ('in-progress', 'authorized', 'completed')
+
+# Braintree statuses from which a transaction can only be refunded, or
+# neither voided nor refunded. They never change back so they can be
+# trusted whatever their age.
+BRAINTREE_FINAL_STATUSES = (
+    'settling', 'settlement_pending', 'settled', 'settlement_confirmed',
+    'voided', 'authorization_expired', 'processor_declined',
+    'gateway_rejected', 'settlement_declined', 'failed',
+)
+
+# Braintree transaction status implied by each kind of webhook notification
+BRAINTREE_WEBHOOK_STATUSES = {
+    'transaction_disbursed': 'settled',
+    'transaction_settled': 'settled',
+    'transaction_settlement_declined': 'settlement_declined',
+    'disbursement': 'settled',
+}
+
 
 class PaymentGatewayBraintree:
     "Braintree Gateway Implementation"
@@ -54,6 +118,21 @@ class PaymentGatewayBraintree:
         }, depends=['provider', 'active']
     )
 
+    _braintree_client_cache = Cache(
+        'payment_gateway.gateway.braintree_client', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayBraintree, cls).__setup__()
+        cls.__rpc__.update({
+            'get_braintree_http_stats': RPC(instantiate=0),
+            'braintree_webhook': RPC(readonly=False),
+            'braintree_webhook_verify': RPC(),
+            'get_braintree_metrics': RPC(),
+            'get_braintree_metrics_prometheus': RPC(),
+        })
+
     @classmethod
     def get_providers(cls, values=None):
         """
@@ -80,14 +159,234 @@ class PaymentGatewayBraintree:
             }
         )]
 
-    def configure_braintree_client(self):
-        assert self.provider == 'braintree'
+    @classmethod
+    def write(cls, *args):
+        super(PaymentGatewayBraintree, cls).write(*args)
+        cls._braintree_client_cache.clear()
+
+    @classmethod
+    def delete(cls, gateways):
+        super(PaymentGatewayBraintree, cls).delete(gateways)
+        cls._braintree_client_cache.clear()
+
+    def get_braintree_environment(self):
+        """
+        Return the braintree environment the gateway talks to
+        """
         if self.test:
-            environment = braintree.Environment.Sandbox
+            return braintree.Environment.Sandbox
+        return braintree.Environment.Production
+
+    def get_braintree_http_strategy(self):
+        """
+        Return the HTTP strategy used by the braintree client of this gateway.
+
+        The pool can be tuned in the `braintree` section of the trytond
+        configuration file with `pool_size`, `connect_timeout`,
+        `read_timeout` and `pool_idle_timeout` (timeouts in seconds).
+        """
+        return partial(
+            PooledHttp,
+            pool_size=config.getint('braintree', 'pool_size', default=10),
+            connect_timeout=config.getfloat(
+                'braintree', 'connect_timeout', default=10
+            ),
+            read_timeout=config.getfloat(
+                'braintree', 'read_timeout', default=60
+            ),
+            idle_timeout=config.getfloat(
+                'braintree', 'pool_idle_timeout', default=60
+            ),
+            breaker=self.get_braintree_circuit_breaker(),
+        )
+
+    def get_braintree_circuit_breaker(self):
+        """
+        Return the circuit breaker guarding the calls to this gateway.
+
+        Its thresholds are read from the `braintree` section of the trytond
+        configuration file: `breaker_window` (number of calls considered, 0
+        disables the breaker), `breaker_min_calls`, `breaker_error_rate`,
+        `breaker_slow_call` (seconds), `breaker_slow_rate` and
+        `breaker_reset_timeout` (seconds before a probe call is let
+        through).
+        """
+        window = config.getint('braintree', 'breaker_window', default=20)
+        if not window:
+            return None
+        return CircuitBreaker.get(
+            (Transaction().database.name, self.id),
+            window=window,
+            min_calls=config.getint(
+                'braintree', 'breaker_min_calls', default=10
+            ),
+            error_rate=config.getfloat(
+                'braintree', 'breaker_error_rate', default=0.5
+            ),
+            slow_call=config.getfloat(
+                'braintree', 'breaker_slow_call', default=10
+            ),
+            slow_rate=config.getfloat(
+                'braintree', 'breaker_slow_rate', default=0.5
+            ),
+            reset_timeout=config.getfloat(
+                'braintree', 'breaker_reset_timeout', default=30
+            ),
+        )
+
+    def get_braintree_client(self):
+        """
+        Return a `braintree.BraintreeGateway` configured for this gateway.
+
+        The client is built once per gateway and set of credentials and
+        reused until the gateway record is modified. Unlike
+        `configure_braintree_client` it does not touch the global
+        configuration of the braintree library, and its HTTP connections are
+        kept alive between calls.
+
+        The duration and outcome of every API call made through the client
+        are recorded, see `get_braintree_metrics`.
+        """
+        assert self.provider == 'braintree'
+        key = (
+            self.id, self.test, self.braintree_merchant_id,
+            self.braintree_public_key, self.braintree_api_key,
+        )
+        client = self._braintree_client_cache.get(key)
+        if client is None:
+            self._register_braintree_exporters()
+            client = self._braintree_client_cache.set(
+                key, InstrumentedClient(
+                    braintree.BraintreeGateway(
+                        braintree.Configuration(
+                            self.get_braintree_environment(),
+                            merchant_id=self.braintree_merchant_id,
+                            public_key=self.braintree_public_key,
+                            private_key=self.braintree_api_key,
+                            http_strategy=self.get_braintree_http_strategy(),
+                            wrap_http_exceptions=True,
+                        )
+                    ),
+                    (Transaction().database.name, self.id),
+                )
+            )
+        return client
+
+    @staticmethod
+    def _register_braintree_exporters():
+        """
+        Send the metrics to statsd if `statsd_host` is set in the
+        `braintree` configuration section (with `statsd_port` and
+        `statsd_prefix`).
+        """
+        host = config.get('braintree', 'statsd_host')
+        if host:
+            metrics.add_exporter(StatsdExporter.get(
+                host,
+                config.getint('braintree', 'statsd_port', default=8125),
+                config.get('braintree', 'statsd_prefix', default='braintree'),
+            ))
+
+    @classmethod
+    def get_braintree_metrics(cls):
+        """
+        Return the latency histograms, outcome counts (success, decline,
+        error) and in-flight calls of the Braintree API calls made by this
+        database, by gateway and operation.
+        """
+        return metrics.snapshot(database=Transaction().database.name)
+
+    @classmethod
+    def get_braintree_metrics_prometheus(cls):
+        """
+        Return `get_braintree_metrics` in the Prometheus text format, for a
+        web front end to serve to the Prometheus scraper.
+        """
+        return PrometheusExporter().render(cls.get_braintree_metrics())
+
+    def get_braintree_http_stats(self):
+        """
+        Return the connection pool counters of this gateway's client
+        """
+        return self.get_braintree_client().config.http_strategy().stats()
+
+    @classmethod
+    def braintree_webhook(cls, gateway_id, bt_signature, bt_payload):
+        """
+        Verify and apply a Braintree webhook notification sent to the
+        gateway.
+
+        The web front end receiving the webhook should pass the
+        `bt_signature` and `bt_payload` form values as they are. The
+        notification can safely be delivered more than once.
+
+        Returns the kind of the notification and the number of transactions
+        that were updated.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        gateway = cls(gateway_id)
+        client = gateway.get_braintree_client()
+        try:
+            notification = client.webhook_notification.parse(
+                bt_signature, bt_payload
+            )
+        except BraintreeError as exc:
+            raise UserError(exc)
+
+        kind = notification.kind
+        status = BRAINTREE_WEBHOOK_STATUSES.get(kind)
+        if getattr(notification, 'transaction', None) is not None:
+            status = status or getattr(
+                notification.transaction, 'status', None
+            )
+            references = [notification.transaction.id]
+        elif getattr(notification, 'disbursement', None) is not None and \
+                kind == 'disbursement':
+            references = notification.disbursement.transaction_ids
         else:
-            environment = braintree.Environment.Production
+            references = []
+
+        updated = 0
+        if status and references:
+            transactions = PaymentTransaction.search([
+                ('gateway', '=', gateway.id),
+                ('type', '=', 'charge'),
+                ('provider_reference', 'in', references),
+            ])
+            updated = PaymentTransaction._apply_braintree_status(
+                transactions, dict.fromkeys(references, status)
+            )
+        return {'kind': kind, 'updated': updated}
+
+    @classmethod
+    def braintree_webhook_verify(cls, gateway_id, challenge):
+        """
+        Answer the challenge Braintree sends when a webhook is registered
+        """
+        gateway = cls(gateway_id)
+        try:
+            return gateway.get_braintree_client().webhook_notification.verify(
+                challenge
+            )
+        except BraintreeError as exc:
+            raise UserError(exc)
+
+    def configure_braintree_client(self):
+        """
+        Configure the global braintree library for this gateway.
+
+        Deprecated: the global configuration is shared by every thread of
+        the server, so concurrent requests against different gateways could
+        be sent with the wrong credentials. Use `get_braintree_client`.
+        """
+        assert self.provider == 'braintree'
+        warnings.warn(
+            'configure_braintree_client is deprecated, '
+            'use get_braintree_client', DeprecationWarning
+        )
         braintree.Configuration.configure(
-            environment,
+            self.get_braintree_environment(),
             merchant_id=self.braintree_merchant_id,
             public_key=self.braintree_public_key,
             private_key=self.braintree_api_key,
@@ -100,20 +399,105 @@ class PaymentTransactionBraintree:
     """
     __name__ = 'payment_gateway.transaction'
 
-    def authorize_braintree(self, card_info=None):
+    braintree_status = fields.Char('Braintree Status', readonly=True)
+    braintree_status_date = fields.DateTime(
+        'Braintree Status Date', readonly=True
+    )
+    braintree_operation = fields.Selection([
+        (None, ''),
+        ('authorize', 'Authorize'),
+        ('capture', 'Capture'),
+    ], 'Braintree Operation', readonly=True,
+        help="The operation the charge was made with, a failed charge is "
+        "retried with the same one")
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionBraintree, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Backs the lookups by provider reference of refunds, webhooks and
+        # the status sync. Draft transactions have no reference yet.
+        add_partial_index(
+            table, 'payment_gateway_transaction_provider_reference_index',
+            ['gateway', 'provider_reference'],
+            '"provider_reference" IS NOT NULL'
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        # The uuid is sent as order id to find out whether a charge went
+        # through, but default values are computed once for all the
+        # records created together.
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            values.setdefault('uuid', cls.default_uuid())
+        return super(PaymentTransactionBraintree, cls).create(vlist)
+
+    @classmethod
+    def copy(cls, records, default=None):
+        # Copy the records one by one so that each gets its own uuid
+        new_records = []
+        for record in records:
+            new_records.extend(super(PaymentTransactionBraintree, cls).copy(
+                [record], default=dict(default or {})
+            ))
+        return new_records
+
+    @classmethod
+    def authorize(cls, transactions):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        with TransactionLog.buffered():
+            super(PaymentTransactionBraintree, cls).authorize(transactions)
+
+    @classmethod
+    def capture(cls, transactions):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        with TransactionLog.buffered():
+            super(PaymentTransactionBraintree, cls).capture(transactions)
+
+    @classmethod
+    def settle(cls, transactions):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        with TransactionLog.buffered():
+            super(PaymentTransactionBraintree, cls).settle(transactions)
+
+    @classmethod
+    def cancel(cls, transactions):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        with TransactionLog.buffered():
+            super(PaymentTransactionBraintree, cls).cancel(transactions)
+
+    @classmethod
+    def refund(cls, transactions):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        with TransactionLog.buffered():
+            super(PaymentTransactionBraintree, cls).refund(transactions)
+
+    def authorize_braintree(self, card_info=None, store_in_vault=False):
         """
         Authorize using Braintree.
+
+        If `store_in_vault` is set, the card given by `card_info` is saved
+        by Braintree along with the charge and a payment profile is created
+        for it.
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
 
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
         charge_data = self.get_braintree_charge_data(card_info=card_info)
         # charge_data['todo'] = 'auth_%s' % self.uuid
         charge_data['options']['submit_for_settlement'] = False
+        if store_in_vault and card_info:
+            self._store_braintree_card_in_vault(charge_data)
+        self.braintree_operation = 'authorize'
 
         try:
-            charge = braintree.Transaction.sale(charge_data)
+            self._check_braintree_card(card_info)
+            charge = self._braintree_sale(client, charge_data)
         except BraintreeError as exc:
             self.state = 'failed'
             self.save()
@@ -122,6 +506,11 @@ class PaymentTransactionBraintree:
             if charge.is_success:
                 self.state = 'authorized'
                 self.provider_reference = charge.transaction.id
+                self._set_braintree_status(charge.transaction.status)
+                if store_in_vault and card_info:
+                    self._create_braintree_profile_from_sale(
+                        card_info, charge.transaction
+                    )
             else:
                 self.state = 'failed'
                 TransactionLog.log_braintree_errors(self, charge)
@@ -135,12 +524,11 @@ class PaymentTransactionBraintree:
 
         assert self.state == 'authorized'
 
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
         try:
-            charge = braintree.Transaction.submit_for_settlement(
-                self.provider_reference,
-                self.amount
+            charge = self._braintree_submit_for_settlement(
+                client, self.provider_reference, self.amount
             )
         except BraintreeError as exc:
             self.state = 'failed'
@@ -150,25 +538,56 @@ class PaymentTransactionBraintree:
             if charge.is_success:
                 self.state = 'completed'
                 self.provider_reference = charge.transaction.id
+                self._set_braintree_status(charge.transaction.status)
             else:
                 self.state = 'failed'
                 TransactionLog.log_braintree_errors(self, charge)
             self.save()
             self.safe_post()
 
-    def capture_braintree(self, card_info=None):
+    def capture_braintree(
+        self, card_info=None, store_in_vault=False, deferred=None
+    ):
         """
         Capture using Braintree.
+
+        If `store_in_vault` is set, the card given by `card_info` is saved
+        by Braintree along with the charge and a payment profile is created
+        for it.
+
+        If `deferred` is set (`deferred_capture` of the `braintree`
+        configuration section by default), a charge against the payment
+        profile is only queued and left in progress, the capture queue
+        workers make it later. Charges of a card given by `card_info` are
+        always made right away as the card details are never stored.
+
+        Charges against a profile whose card is flagged as expired fail
+        without calling Braintree.
         """
-        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        pool = Pool()
+        TransactionLog = pool.get('payment_gateway.transaction.log')
+        Queue = pool.get('payment_gateway.transaction.braintree_queue')
+
+        if deferred is None:
+            deferred = config.getboolean(
+                'braintree', 'deferred_capture', default=False
+            )
+        if deferred and not card_info and \
+                not self._get_braintree_card_error():
+            Queue.enqueue([self])
+            return
 
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
         charge_data = self.get_braintree_charge_data(card_info=card_info)
         # charge_data['todo'] = 'capture_%s' % self.uuid
         charge_data['options']['submit_for_settlement'] = True
+        if store_in_vault and card_info:
+            self._store_braintree_card_in_vault(charge_data)
+        self.braintree_operation = 'capture'
         try:
-            charge = braintree.Transaction.sale(charge_data)
+            self._check_braintree_card(card_info)
+            charge = self._braintree_sale(client, charge_data)
         except BraintreeError as exc:
             self.state = 'failed'
             self.save()
@@ -177,12 +596,420 @@ class PaymentTransactionBraintree:
             if charge.is_success:
                 self.state = 'completed'
                 self.provider_reference = charge.transaction.id
+                self._set_braintree_status(charge.transaction.status)
+                if store_in_vault and card_info:
+                    self._create_braintree_profile_from_sale(
+                        card_info, charge.transaction
+                    )
             else:
                 self.state = 'failed'
                 TransactionLog.log_braintree_errors(self, charge)
             self.save()
             self.safe_post()
 
+    def _get_braintree_card_error(self, card_info=None):
+        """
+        Return the error charging the payment profile is known to end with,
+        None if it can be charged.
+        """
+        if not card_info and self.payment_profile and \
+                self.payment_profile.braintree_expired:
+            return 'The card of payment profile %s expired.' % (
+                self.payment_profile.rec_name
+            )
+
+    def _check_braintree_card(self, card_info=None):
+        """
+        Raise an `ExpiredCardError` instead of charging a card which is
+        known to be expired.
+        """
+        error = self._get_braintree_card_error(card_info)
+        if error:
+            raise ExpiredCardError(error)
+
+    def _store_braintree_card_in_vault(self, charge_data):
+        """
+        Ask Braintree to save the card of the charge, under the customer of
+        the party if there is one already.
+        """
+        customer_id = self.party._get_braintree_customer_id(self.gateway)
+        if customer_id:
+            charge_data['customer_id'] = customer_id
+        charge_data['options']['store_in_vault_on_success'] = True
+
+    def _create_braintree_profile_from_sale(self, card_info, txn):
+        """
+        Create the payment profile of the card saved with the Braintree
+        transaction `txn` and use it for this transaction.
+        """
+        Profile = Pool().get('party.payment_profile')
+
+        card = txn.credit_card_details
+        profile = Profile(
+            name=card_info.owner or card.cardholder_name,
+            party=self.party.id,
+            address=self.address.id,
+            gateway=self.gateway.id,
+            last_4_digits=card.last_4,
+            expiry_month=card.expiration_month,
+            expiry_year=card.expiration_year,
+            provider_reference=card.token,
+            braintree_customer_id=txn.customer_details.id,
+        )
+        profile.save()
+        self.payment_profile = profile
+        return profile
+
+    @classmethod
+    def _write_braintree_batch_results(
+        cls, transactions, results, success_state, failure_state
+    ):
+        """
+        Write in bulk the outcome of a batch of Braintree calls and return
+        the successful transactions.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        to_write, failed, completed = [], [], []
+        with TransactionLog.buffered():
+            for transaction, (result, exc) in zip(transactions, results):
+                if exc is not None:
+                    failed.append(transaction)
+                    TransactionLog.serialize_and_create(transaction, exc)
+                elif result.is_success:
+                    completed.append(transaction)
+                    values = cls._braintree_status_values(
+                        result.transaction.status
+                    )
+                    values.update({
+                        'state': success_state,
+                        'provider_reference': result.transaction.id,
+                    })
+                    to_write.extend(([transaction], values))
+                else:
+                    failed.append(transaction)
+                    TransactionLog.log_braintree_errors(transaction, result)
+            if failed and failure_state:
+                to_write.extend((failed, {'state': failure_state}))
+            if to_write:
+                cls.write(*to_write)
+        return completed
+
+    @classmethod
+    def _run_braintree_batch(
+        cls, transactions, prepare, workers=None, commit=False,
+        success_state='completed', failure_state='failed'
+    ):
+        """
+        Run a Braintree operation for many transactions.
+
+        `prepare` is called with every transaction and must return a tuple
+        of the gateway and a callable doing the API call. Those callables
+        run concurrently, with at most `workers` threads overall and at most
+        `gateway_concurrency` (from the `braintree` configuration section)
+        per gateway. Successful transactions are moved to `success_state`
+        and posted if it is completed, the others are moved to
+        `failure_state` (left as they are if it is None) and their errors
+        logged.
+
+        Transactions are processed in chunks of `batch_chunk_size`, each
+        chunk being written in bulk. If `commit` is set the database
+        transaction is committed after each chunk, so that a failure does
+        not roll back the state of payments already processed by Braintree.
+        """
+        report = BatchReport()
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        gateway_concurrency = config.getint(
+            'braintree', 'gateway_concurrency', default=0
+        )
+        transactions = list(transactions)
+        for index in xrange(0, len(transactions), chunk_size):
+            chunk = transactions[index:index + chunk_size]
+            jobs = [prepare(transaction) for transaction in chunk]
+            results = map_concurrently(
+                lambda job: job[1](), jobs, workers,
+                key=lambda job: job[0].id, key_limit=gateway_concurrency,
+            )
+
+            completed = cls._write_braintree_batch_results(
+                chunk, results, success_state, failure_state
+            )
+            if success_state == 'completed':
+                for transaction in completed:
+                    transaction.safe_post()
+
+            for transaction in chunk:
+                report.add(transaction, transaction.state)
+            if commit:
+                Transaction().commit()
+        return report.stop().as_dict()
+
+    @classmethod
+    def capture_braintree_batch(cls, transactions, workers=None, commit=False):
+        """
+        Capture many transactions against their saved payment profiles.
+
+        The charges are sent concurrently through a bounded pool of
+        `workers` threads (the `batch_workers` option of the `braintree`
+        configuration section by default) and the resulting states are
+        written back in bulk.
+
+        Only draft transactions of Braintree gateways are captured, the
+        others are left untouched. A transaction whose charge data can not
+        be built fails and the error is logged, the batch goes on.
+
+        Returns a dictionary with the state reached by every transaction
+        and throughput figures.
+        """
+        transactions = [
+            t for t in transactions
+            if t.state == 'draft' and t.gateway.provider == 'braintree'
+        ]
+        charges = cls._get_braintree_charges(transactions)
+
+        def prepare(transaction):
+            data = charges[transaction.id]
+            error = transaction._get_braintree_card_error()
+            if error:
+                data = ExpiredCardError(error)
+            if isinstance(data, Exception):
+                return transaction.gateway, failing(data)
+            client = transaction.gateway.get_braintree_client()
+            data['options']['submit_for_settlement'] = True
+            return (
+                transaction.gateway,
+                lambda: cls._braintree_sale(client, data)
+            )
+
+        return cls._run_braintree_batch(
+            transactions, prepare, workers=workers, commit=commit
+        )
+
+    @classmethod
+    def settle_braintree_batch(cls, transactions, workers=None, commit=False):
+        """
+        Settle many authorized transactions.
+
+        Works like `capture_braintree_batch`, transactions which are not
+        authorized are left untouched.
+        """
+        def prepare(transaction):
+            client = transaction.gateway.get_braintree_client()
+            provider_reference = transaction.provider_reference
+            amount = transaction.amount
+            return (
+                transaction.gateway,
+                lambda: cls._braintree_submit_for_settlement(
+                    client, provider_reference, amount
+                )
+            )
+
+        return cls._run_braintree_batch(
+            [t for t in transactions if t.state == 'authorized'], prepare,
+            workers=workers, commit=commit
+        )
+
+    @classmethod
+    def cancel_braintree_batch(cls, transactions, workers=None, commit=False):
+        """
+        Void many authorized transactions.
+
+        Works like `settle_braintree_batch`. Voided transactions are
+        cancelled, those Braintree refused to void stay authorized.
+        """
+        def prepare(transaction):
+            client = transaction.gateway.get_braintree_client()
+            provider_reference = transaction.provider_reference
+            return (
+                transaction.gateway,
+                lambda: client.transaction.void(provider_reference)
+            )
+
+        return cls._run_braintree_batch(
+            [t for t in transactions if t.state == 'authorized'], prepare,
+            workers=workers, commit=commit,
+            success_state='cancel', failure_state=None,
+        )
+
+    @classmethod
+    def _get_braintree_authorizations_domain(cls, age):
+        """
+        Domain of the Braintree authorizations created more than `age`
+        seconds ago
+        """
+        return [
+            ('gateway.provider', '=', 'braintree'),
+            ('type', '=', 'charge'),
+            ('state', '=', 'authorized'),
+            ('provider_reference', '!=', None),
+            ('create_date', '<=', datetime.now() - timedelta(seconds=age)),
+        ]
+
+    @classmethod
+    def get_braintree_auto_settle_domain(cls):
+        """
+        Return the domain of the authorizations settled by
+        `auto_settle_braintree`: those older than `auto_settle_delay`
+        seconds (from the `braintree` configuration section) which are not
+        stale yet.
+
+        Downstream modules can extend it with their own rules.
+        """
+        delay = config.getint('braintree', 'auto_settle_delay', default=0)
+        stale_age = config.getint(
+            'braintree', 'stale_authorization_age', default=432000
+        )
+        return cls._get_braintree_authorizations_domain(delay) + [
+            ('create_date', '>', datetime.now() - timedelta(
+                seconds=stale_age)),
+        ]
+
+    @classmethod
+    def get_braintree_stale_domain(cls):
+        """
+        Return the domain of the authorizations voided by
+        `void_stale_braintree`: those older than `stale_authorization_age`
+        seconds (from the `braintree` configuration section).
+        """
+        stale_age = config.getint(
+            'braintree', 'stale_authorization_age', default=432000
+        )
+        return cls._get_braintree_authorizations_domain(stale_age)
+
+    @classmethod
+    def _run_braintree_cron(cls, domain, batch, commit=True):
+        """
+        Call `batch` on the transactions matching `domain`, read from the
+        database in chunks of `batch_chunk_size`, and return the statistics
+        of the run. Unless `commit` is unset, the database transaction is
+        committed after each chunk.
+        """
+        report = BatchReport()
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        last_id = 0
+        while True:
+            transactions = cls.search(
+                [('id', '>', last_id)] + domain,
+                order=[('id', 'ASC')], limit=chunk_size
+            )
+            if not transactions:
+                break
+            last_id = transactions[-1].id
+            outcomes = batch(transactions, commit=commit)['outcomes']
+            report.outcomes.update(outcomes)
+
+        stats = report.stop().as_dict()
+        del stats['outcomes']
+        return stats
+
+    @classmethod
+    def auto_settle_braintree(cls, commit=True):
+        """
+        Settle the authorizations matching the auto settle rules.
+
+        Meant to be run by the scheduler.
+        """
+        stats = cls._run_braintree_cron(
+            cls.get_braintree_auto_settle_domain(), cls.settle_braintree_batch,
+            commit=commit
+        )
+        logger.info('Braintree auto settlement: %s', stats)
+        return stats
+
+    @classmethod
+    def void_stale_braintree(cls, commit=True):
+        """
+        Void the stale authorizations.
+
+        Meant to be run by the scheduler.
+        """
+        stats = cls._run_braintree_cron(
+            cls.get_braintree_stale_domain(), cls.cancel_braintree_batch,
+            commit=commit
+        )
+        logger.info('Braintree stale authorizations voided: %s', stats)
+        return stats
+
+    @staticmethod
+    def _call_braintree_with_retry(func, recover=None):
+        """
+        Call `func` with the retry policy of the `braintree` configuration
+        section: `retry_attempts` calls at most, waiting up to
+        `retry_backoff` seconds before the first retry, doubled at each
+        retry without exceeding `retry_max_backoff`.
+        """
+        return call_with_retry(
+            func,
+            attempts=config.getint('braintree', 'retry_attempts', default=3),
+            backoff=config.getfloat(
+                'braintree', 'retry_backoff', default=0.5
+            ),
+            max_backoff=config.getfloat(
+                'braintree', 'retry_max_backoff', default=8
+            ),
+            recover=recover,
+        )
+
+    @staticmethod
+    def _find_braintree_sale(client, order_id, amount):
+        """
+        Return a successful result for the sale of `amount` made with
+        `order_id` if there is one, None otherwise.
+        """
+        result = client.transaction.search(
+            braintree.TransactionSearch.order_id == order_id
+        )
+        for txn in result.items:
+            if BRAINTREE_STATES.get(txn.status) in (
+                    'authorized', 'completed') and \
+                    txn.amount == Decimal(amount):
+                return braintree.SuccessfulResult({'transaction': txn})
+
+    @classmethod
+    def _braintree_sale(cls, client, charge_data):
+        """
+        Create a sale, retrying after transient errors.
+
+        Before retrying, the sale is looked up by its order id so that a
+        sale processed by Braintree despite the error is not made twice.
+        Without an order id the sale is never retried.
+
+        Only talks to Braintree so it can be called from other threads.
+        """
+        order_id = charge_data.get('order_id')
+        if not order_id:
+            return client.transaction.sale(charge_data)
+        return cls._call_braintree_with_retry(
+            lambda: client.transaction.sale(charge_data),
+            recover=lambda: cls._find_braintree_sale(
+                client, order_id, charge_data['amount']
+            ),
+        )
+
+    @classmethod
+    def _braintree_submit_for_settlement(cls, client, reference, amount):
+        """
+        Submit an authorization for settlement, retrying after transient
+        errors unless Braintree already got the submission.
+
+        Only talks to Braintree so it can be called from other threads.
+        """
+        def recover():
+            txn = client.transaction.find(reference)
+            if BRAINTREE_STATES.get(txn.status) == 'completed':
+                return braintree.SuccessfulResult({'transaction': txn})
+
+        return cls._call_braintree_with_retry(
+            lambda: client.transaction.submit_for_settlement(
+                reference, amount
+            ),
+            recover=recover,
+        )
+
     def get_braintree_charge_data(self, card_info=None):
         """
         Downstream modules can modify this method to send extra data to
@@ -190,6 +1017,7 @@ class PaymentTransactionBraintree:
         """
         charge_data = {
             "amount": self.amount,
+            "order_id": self.uuid,
             "options": {},
             "customer": {},
         }
@@ -221,19 +1049,270 @@ class PaymentTransactionBraintree:
 
         return charge_data
 
+    @classmethod
+    def get_braintree_charge_data_batch(cls, transactions):
+        """
+        Return the charge data of each transaction, as built by
+        `get_braintree_charge_data`, for many transactions.
+
+        The transactions are browsed together so that their parties,
+        addresses, payment profiles, gateways and the subdivisions and
+        countries of the addresses are each read in bulk, and the Braintree
+        customer ids of the parties are fetched with a few searches.
+        """
+        return [
+            t.get_braintree_charge_data()
+            for t in cls._browse_braintree_charges(transactions)
+        ]
+
+    @classmethod
+    def _browse_braintree_charges(cls, transactions):
+        """
+        Browse the transactions together and prefetch the customer ids of
+        their parties, see `get_braintree_charge_data_batch`.
+        """
+        Party = Pool().get('party.party')
+
+        transactions = cls.browse([t.id for t in transactions])
+        Party._prefetch_braintree_customer_ids(
+            (t.party.id, t.gateway.id) for t in transactions
+        )
+        return transactions
+
+    @classmethod
+    def _get_braintree_charges(cls, transactions):
+        """
+        Return by transaction id the charge data built like
+        `get_braintree_charge_data_batch`, or the error raised building it
+        when the record can not be charged (no card or profile, currency
+        mismatch), so that one bad record does not abort a whole batch.
+        Any other error is raised.
+        """
+        charges = {}
+        for transaction in cls._browse_braintree_charges(transactions):
+            try:
+                charges[transaction.id] = \
+                    transaction.get_braintree_charge_data()
+            except (UserError, AssertionError) as exc:
+                charges[transaction.id] = exc
+        return charges
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, transactions):
+        """
+        Retry failed Braintree charges, other transactions are handed to
+        the generic implementation.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        braintree_transactions = [
+            t for t in transactions if t.gateway.provider == 'braintree'
+        ]
+        others = [t for t in transactions if t not in braintree_transactions]
+        with TransactionLog.buffered():
+            for transaction in braintree_transactions:
+                transaction.retry_braintree()
+        if others:
+            super(PaymentTransactionBraintree, cls).retry(others)
+
     def retry_braintree(self, credit_card=None):
         """
         Retry charge
 
+        If an earlier attempt was processed by Braintree even though it
+        failed here, that charge is used instead of charging again.
+        Otherwise the charge is made again with the operation it was first
+        made with: authorizations are authorized again, other charges are
+        captured.
+
         :param credit_card: An instance of CreditCardView
         """
-        raise self.raise_user_error('feature_not_available')
+        if self.state != 'failed' or self.type != 'charge':
+            return
+
+        client = self.gateway.get_braintree_client()
+        try:
+            charge = self._find_braintree_sale(client, self.uuid, self.amount)
+        except BraintreeError as exc:
+            TransactionLog = Pool().get('payment_gateway.transaction.log')
+            TransactionLog.serialize_and_create(self, exc)
+            return
+
+        if charge is None:
+            if self.braintree_operation == 'authorize':
+                self.authorize_braintree(card_info=credit_card)
+            else:
+                self.capture_braintree(card_info=credit_card)
+            return
+
+        self.state = BRAINTREE_STATES[charge.transaction.status]
+        self.provider_reference = charge.transaction.id
+        self._set_braintree_status(charge.transaction.status)
+        self.save()
+        if self.state == 'completed':
+            self.safe_post()
 
     def update_braintree(self):
         """
         Update the status of the transaction from Braintree
         """
-        raise self.raise_user_error('feature_not_available')
+        self.update_braintree_batch([self])
+
+    @classmethod
+    def update_braintree_batch(cls, transactions):
+        """
+        Update the status of many transactions from Braintree.
+
+        The transactions of each gateway are looked up with one
+        `Transaction.search` per chunk of `search_chunk_size` references
+        (from the `braintree` configuration section) instead of one `find`
+        per transaction, and the new states are written in bulk.
+        """
+        report = BatchReport()
+        chunk_size = config.getint(
+            'braintree', 'search_chunk_size', default=1000
+        )
+
+        by_gateway = {}
+        for transaction in transactions:
+            if transaction.type != 'charge' or \
+                    not transaction.provider_reference or \
+                    not transaction._braintree_status_may_change():
+                continue
+            by_gateway.setdefault(transaction.gateway, []).append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.iteritems():
+            client = gateway.get_braintree_client()
+            for index in xrange(0, len(gateway_transactions), chunk_size):
+                chunk = gateway_transactions[index:index + chunk_size]
+                statuses = cls._search_braintree_statuses(
+                    client, [t.provider_reference for t in chunk]
+                )
+                cls._apply_braintree_status(chunk, statuses)
+                for transaction in chunk:
+                    report.add(transaction, transaction.state)
+        return report.stop().as_dict()
+
+    def _braintree_status_may_change(self):
+        """
+        Tell whether the state or the Braintree status of this transaction
+        can still change on Braintree's side
+        """
+        return self.state in BRAINTREE_PENDING_STATES or (
+            self.state == 'posted' and
+            self.braintree_status not in BRAINTREE_FINAL_STATUSES
+        )
+
+    @staticmethod
+    def _search_braintree_statuses(client, references):
+        """
+        Return the status of the Braintree transactions with the given ids
+        """
+        result = client.transaction.search(
+            braintree.TransactionSearch.ids.in_list(references)
+        )
+        return dict((txn.id, txn.status) for txn in result.items)
+
+    @classmethod
+    def _apply_braintree_status(cls, transactions, statuses):
+        """
+        Bring the state of the transactions in line with their Braintree
+        status. `statuses` maps Braintree transaction ids to their status.
+
+        Transactions already in the matching state are left alone, so
+        applying the same statuses twice is harmless. The Braintree status
+        is recorded on every transaction whose status changed.
+
+        Posted transactions keep their state, as their accounting is done.
+        If Braintree declined their settlement, a warning is logged on them
+        so that they can be dealt with, see
+        `get_braintree_posted_declined_domain`.
+
+        Returns the number of transactions whose state changed.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        by_state, by_status, declined = {}, {}, []
+        for transaction in transactions:
+            status = statuses.get(transaction.provider_reference)
+            state = BRAINTREE_STATES.get(status)
+            if status and status != transaction.braintree_status:
+                by_status.setdefault(status, []).append(transaction)
+                if transaction.state == 'posted' and state == 'failed':
+                    declined.append((transaction, status))
+            if state is None or state == transaction.state or \
+                    state == 'in-progress' or \
+                    transaction.state not in BRAINTREE_PENDING_STATES or \
+                    (transaction.state == 'completed' and
+                        state == 'authorized'):
+                continue
+            by_state.setdefault(state, []).append(transaction)
+
+        to_write = []
+        for status, records in by_status.iteritems():
+            to_write.extend((records, cls._braintree_status_values(status)))
+        for state, records in by_state.iteritems():
+            to_write.extend((records, {'state': state}))
+        if to_write:
+            cls.write(*to_write)
+        if declined:
+            TransactionLog.log_braintree_posted_declined(declined)
+
+        for transaction in by_state.get('completed', []):
+            transaction.safe_post()
+        return sum(len(records) for records in by_state.itervalues())
+
+    @classmethod
+    def get_braintree_posted_declined_domain(cls):
+        """
+        Return the domain of the posted Braintree charges whose payment
+        Braintree declined afterwards, as their accounting must be undone.
+        """
+        return [
+            ('gateway.provider', '=', 'braintree'),
+            ('type', '=', 'charge'),
+            ('state', '=', 'posted'),
+            ('braintree_status', 'in', [
+                status for status, state in BRAINTREE_STATES.iteritems()
+                if state == 'failed'
+            ]),
+        ]
+
+    @classmethod
+    def sync_braintree_transactions(cls):
+        """
+        Update every Braintree transaction which is not in a final state,
+        including the posted charges whose Braintree status is not final.
+
+        Meant to be run by the scheduler.
+        """
+        chunk_size = config.getint(
+            'braintree', 'search_chunk_size', default=1000
+        )
+        last_id = 0
+        while True:
+            transactions = cls.search([
+                ('id', '>', last_id),
+                ('gateway.provider', '=', 'braintree'),
+                ('type', '=', 'charge'),
+                ['OR', [
+                    ('state', 'in', BRAINTREE_PENDING_STATES),
+                ], [
+                    ('state', '=', 'posted'),
+                    ['OR', [
+                        ('braintree_status', '=', None),
+                    ], [
+                        ('braintree_status', 'not in',
+                            BRAINTREE_FINAL_STATUSES),
+                    ]],
+                ]],
+                ('provider_reference', '!=', None),
+            ], order=[('id', 'ASC')], limit=chunk_size)
+            if not transactions:
+                break
+            last_id = transactions[-1].id
+            cls.update_braintree_batch(transactions)
 
     def cancel_braintree(self):
         """
@@ -244,49 +1323,106 @@ class PaymentTransactionBraintree:
         if self.state != 'authorized':
             self.raise_user_error('cancel_only_authorized')
 
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
         try:
-            charge = braintree.Transaction.void(self.provider_reference)
+            charge = client.transaction.void(self.provider_reference)
         except BraintreeError as exc:
             TransactionLog.serialize_and_create(self, exc)
         else:
             if charge.is_success:
                 self.state = 'cancel'
+                self._set_braintree_status(charge.transaction.status)
                 self.save()
             else:
                 TransactionLog.log_braintree_errors(self, charge)
 
+    @staticmethod
+    def _braintree_status_values(status):
+        return {
+            'braintree_status': status,
+            'braintree_status_date': datetime.now(),
+        }
+
+    def _set_braintree_status(self, status):
+        for name, value in self._braintree_status_values(status).items():
+            setattr(self, name, value)
+
+    def get_braintree_status(self):
+        """
+        Return the Braintree status last received for the transaction, or
+        None if it is missing, or older than `status_max_age` seconds (from
+        the `braintree` configuration section) and could have changed since.
+        """
+        max_age = config.getint('braintree', 'status_max_age', default=300)
+        status = self.braintree_status
+        if status in BRAINTREE_FINAL_STATUSES or (
+                status and self.braintree_status_date and
+                datetime.now() - self.braintree_status_date <
+                timedelta(seconds=max_age)):
+            return status
+
+    def _void_or_refund_braintree(self, client):
+        """
+        Void or refund the origin of this refund transaction and return the
+        Braintree result.
+        """
+        origin = self.origin
+
+        def void():
+            return client.transaction.void(origin.provider_reference)
+
+        def refund():
+            return client.transaction.refund(
+                origin.provider_reference, self.amount
+            )
+
+        def failed_with(result, code):
+            return not result.is_success and code in [
+                error.code for error in result.errors.deep_errors
+            ]
+
+        # Refunds can only be done on settled payments. before that
+        # braintree required you to void. Since voiding can only be
+        # done on full amount, we support voiding when the refund
+        # amount is for the same amount as original transaction.
+        # Without a recent status the refund is tried first.
+        can_void = origin.amount == self.amount
+        status = origin.get_braintree_status()
+        if can_void and status and status not in BRAINTREE_FINAL_STATUSES:
+            result = void()
+            # The transaction settled since its status was last seen
+            if failed_with(result, ErrorCodes.Transaction.CannotBeVoided):
+                result = refund()
+        else:
+            result = refund()
+            if can_void and failed_with(
+                    result, ErrorCodes.Transaction.CannotRefundUnlessSettled):
+                result = void()
+        return result
+
     def refund_braintree(self):
         TransactionLog = Pool().get('payment_gateway.transaction.log')
 
-        self.gateway.configure_braintree_client()
+        client = self.gateway.get_braintree_client()
 
         try:
-            original_txn = braintree.Transaction.find(
-                self.origin.provider_reference
-            )
-            if original_txn.status not in ('settled', 'settling') \
-                    and original_txn.amount == self.amount:
-                # Refunds can only be done on settled payments. before that
-                # braintree required you to void. Since voiding can only be
-                # done on full amount, we support voiding when the refund
-                # amount is for the same amount as original transaction
-                refund = braintree.Transaction.void(
-                    self.origin.provider_reference
-                )
-            else:
-                refund = braintree.Transaction.refund(
-                    self.origin.provider_reference,
-                    self.amount,
-                )
+            refund = self._void_or_refund_braintree(client)
         except BraintreeError as exc:
             self.state = 'failed'
             self.save()
             TransactionLog.serialize_and_create(self, exc)
         else:
             if refund.is_success:
+                if refund.transaction.id == self.origin.provider_reference:
+                    # The origin was voided
+                    self.origin.write(
+                        [self.origin], self._braintree_status_values(
+                            refund.transaction.status
+                        )
+                    )
                 self.provider_reference = refund.transaction.id
+                self._set_braintree_status(refund.transaction.status)
                 self.state = 'completed'
                 self.save()
             else:
@@ -306,7 +1442,7 @@ class AddPaymentProfile:
         """
         card_info = self.card_info
 
-        card_info.gateway.configure_braintree_client()
+        client = card_info.gateway.get_braintree_client()
 
         card_data = {
             'number': card_info.number,
@@ -322,41 +1458,337 @@ class AddPaymentProfile:
         customer_id = card_info.party._get_braintree_customer_id(
             card_info.gateway
         )
-        if customer_id:
-            card_data['customer_id'] = customer_id
-        else:
-            customer = braintree.Customer.create(
-                card_info.party.get_customer_for_braintree()
-            ).customer
-            card_data['customer_id'] = customer.id
-
         try:
-            card = braintree.CreditCard.create(card_data)
+            if customer_id:
+                card_data['customer_id'] = customer_id
+                result = client.credit_card.create(card_data)
+            else:
+                # Create the customer and its card with a single call
+                customer_data = card_info.party.get_customer_for_braintree()
+                customer_data['credit_card'] = card_data
+                result = client.customer.create(customer_data)
         except BraintreeError as exc:
             raise UserError(exc)
 
-        if not card.is_success:
-            for error in card.errors.deep_errors:
+        if not result.is_success:
+            for error in result.errors.deep_errors:
                 raise UserError(error.message)
+            raise UserError(result.message)
+
+        if customer_id:
+            card = result.credit_card
+        else:
+            card, = result.customer.credit_cards
 
         return self.create_profile(
-            card.credit_card.token,
-            braintree_customer_id=card.credit_card.customer_id
+            card.token, braintree_customer_id=card.customer_id
+        )
+
+
+class BraintreeCaptureQueue(ModelSQL, ModelView):
+    "Braintree Capture Queue"
+    __name__ = 'payment_gateway.transaction.braintree_queue'
+
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', required=True,
+        readonly=True, select=True, ondelete='CASCADE',
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, transactions):
+        """
+        Queue the capture of the transactions and mark them in progress
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        PaymentTransaction.write(transactions, {'state': 'in-progress'})
+        return cls.create([{'transaction': t.id} for t in transactions])
+
+    @classmethod
+    def requeue_stalled(cls):
+        """
+        Put back in the queue the captures left processing for more than
+        `capture_queue_timeout` seconds (from the `braintree` configuration
+        section) by a worker which died.
+        """
+        timeout = config.getint(
+            'braintree', 'capture_queue_timeout', default=600
+        )
+        stalled = cls.search([
+            ('state', '=', 'processing'),
+            ('write_date', '<', datetime.now() - timedelta(seconds=timeout)),
+        ])
+        if stalled:
+            cls.write(stalled, {'state': 'pending'})
+
+    @classmethod
+    def claim(cls, limit):
+        """
+        Mark processing up to `limit` pending entries, oldest first, and
+        return them.
+
+        The entries are locked while claimed so that concurrent workers
+        never claim the same ones: on PostgreSQL the rows already locked by
+        another worker are skipped, other backends lock the table.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        query = table.select(
+            table.id, where=table.state == 'pending',
+            order_by=table.id.asc, limit=limit
+        )
+        if backend.name() == 'postgresql':
+            sql, params = tuple(query)
+            cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+        else:
+            transaction.database.lock(transaction.connection, cls._table)
+            cursor.execute(*query)
+        entries = cls.browse([row[0] for row in cursor.fetchall()])
+        for entry in entries:
+            entry.state = 'processing'
+            entry.attempts += 1
+        cls.save(entries)
+        return entries
+
+    @staticmethod
+    def _prepare_braintree_capture(charges, recovering, transaction):
+        """
+        Return the gateway of the queued transaction and the function
+        capturing it, which looks up first the sale of `recovering`
+        transactions.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        charge_data = charges[transaction.id]
+        error = transaction._get_braintree_card_error()
+        if error:
+            charge_data = ExpiredCardError(error)
+        if isinstance(charge_data, Exception):
+            return transaction.gateway, failing(charge_data)
+        client = transaction.gateway.get_braintree_client()
+        charge_data['options']['submit_for_settlement'] = True
+
+        def capture():
+            if transaction.id in recovering:
+                found = PaymentTransaction._find_braintree_sale(
+                    client, charge_data['order_id'], charge_data['amount']
+                )
+                if found is not None:
+                    return found
+            return PaymentTransaction._braintree_sale(client, charge_data)
+        return transaction.gateway, capture
+
+    @classmethod
+    def process(cls, workers=None, commit=True):
+        """
+        Capture the queued transactions.
+
+        Entries are claimed with `claim` in chunks of `batch_chunk_size`,
+        so that concurrent runs never capture the same entries, and their
+        charges sent through a pool of `workers` threads
+        (`capture_queue_workers` of the `braintree` configuration section
+        by default). Captures claimed before by a worker which died are
+        first looked up by order id so that they are not charged twice.
+        A transaction whose charge data can not be built fails on its own,
+        without holding up the rest of its chunk.
+
+        Unless `commit` is unset, the database transaction is committed
+        once the entries are claimed and once they are processed.
+
+        Meant to be run by the scheduler. Returns the statistics of the run.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        report = BatchReport()
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
         )
+        workers = workers or config.getint(
+            'braintree', 'capture_queue_workers', default=0
+        ) or None
+
+        cls.requeue_stalled()
+        while True:
+            entries = cls.claim(chunk_size)
+            if not entries:
+                break
+            if commit:
+                Transaction().commit()
+
+            transactions = [
+                e.transaction for e in entries
+                if e.transaction.state == 'in-progress'
+            ]
+            recovering = set(
+                e.transaction.id for e in entries if e.attempts > 1
+            )
+            charges = PaymentTransaction._get_braintree_charges(transactions)
+
+            prepare = partial(
+                cls._prepare_braintree_capture, charges, recovering
+            )
+            outcomes = PaymentTransaction._run_braintree_batch(
+                transactions, prepare, workers=workers
+            )['outcomes']
+            report.outcomes.update(outcomes)
+            cls.delete(entries)
+            if commit:
+                Transaction().commit()
+
+        stats = report.stop().as_dict()
+        del stats['outcomes']
+        logger.info('Braintree capture queue processed: %s', stats)
+        return stats
 
 
 class TransactionLog:
     "Braintree Gateway Implementation"
     __name__ = 'payment_gateway.transaction.log'
 
+    _braintree_buffer = threading.local()
+
+    @classmethod
+    @contextmanager
+    def buffered(cls):
+        """
+        Collect the logs created in the block and create them with a single
+        query when it ends. Nested blocks are flushed by the outermost one.
+        """
+        if getattr(cls._braintree_buffer, 'logs', None) is not None:
+            yield
+            return
+        cls._braintree_buffer.logs = []
+        try:
+            yield
+            logs = cls._braintree_buffer.logs
+        finally:
+            cls._braintree_buffer.logs = None
+        if logs:
+            cls.create(logs)
+
+    @classmethod
+    def _create_braintree_logs(cls, vlist):
+        """
+        Create the logs, or add them to the buffer inside `buffered`.
+        Returns the created logs, or an empty list when they are buffered.
+        """
+        buffer_ = getattr(cls._braintree_buffer, 'logs', None)
+        if buffer_ is not None:
+            buffer_.extend(vlist)
+            return []
+        return cls.create(vlist)
+
+    @staticmethod
+    def _dump_braintree_payload(payload):
+        return json.dumps(payload, separators=(',', ':'), sort_keys=True)
+
+    @classmethod
+    def serialize_and_create(cls, transaction, data):
+        """
+        Log a Braintree error as a compact JSON object and return the log.
+
+        Inside `buffered` the log is only created when the block ends, so
+        None is returned instead.
+        """
+        if not isinstance(data, BraintreeError):
+            return super(TransactionLog, cls).serialize_and_create(
+                transaction, data
+            )
+        logger.warning(
+            'Braintree %s on transaction %s: %s',
+            data.__class__.__name__, transaction.id, data
+        )
+        logs = cls._create_braintree_logs([{
+            'transaction': transaction,
+            'log': cls._dump_braintree_payload({
+                'exception': data.__class__.__name__,
+                'message': unicode(data),
+            }),
+            'is_system_generated': True,
+        }])
+        return logs[0] if logs else None
+
+    @classmethod
+    def _braintree_error_paths(cls, data, path=()):
+        """
+        Yield the errors of a Braintree validation error tree with the path
+        of the attribute they apply to.
+        """
+        for error in data.get('errors') or []:
+            yield error, '.'.join(path + (error.get('attribute', ''),))
+        for key, nested in data.iteritems():
+            if key != 'errors' and isinstance(nested, dict):
+                for item in cls._braintree_error_paths(
+                        nested, path + (key,)):
+                    yield item
+
+    @classmethod
+    def log_braintree_posted_declined(cls, declined):
+        """
+        Log on posted transactions that Braintree declined them.
+        `declined` is a list of `(transaction, status)` pairs.
+        """
+        for transaction, status in declined:
+            logger.warning(
+                'Braintree status %s on posted transaction %s',
+                status, transaction.id
+            )
+        return cls._create_braintree_logs([{
+            'transaction': transaction,
+            'log': cls._dump_braintree_payload({
+                'message': 'Declined by Braintree after being posted',
+                'status': status,
+            }),
+            'is_system_generated': True,
+        } for transaction, status in declined])
+
     @classmethod
     def log_braintree_errors(cls, transaction, result):
-        text = [result.message]
-        for error in result.errors.deep_errors:
-            text.append(error.message)
-        print text
-        return cls.create([{
+        """
+        Log the errors of an unsuccessful Braintree result.
+
+        The log is a compact JSON object with the message, the error codes
+        and attribute paths, and the processor response if a transaction
+        was created.
+        """
+        payload = {
+            'message': result.message,
+            'errors': [{
+                'code': error['code'],
+                'path': path,
+            } for error, path in cls._braintree_error_paths(
+                result.errors.errors.data
+            )],
+        }
+        if result.transaction is not None:
+            for name in [
+                    'status', 'processor_response_code',
+                    'processor_response_text', 'gateway_rejection_reason']:
+                value = getattr(result.transaction, name, None)
+                if value is not None:
+                    payload[name] = value
+        logger.info(
+            'Braintree error on transaction %s: %s (%s)',
+            transaction.id, result.message,
+            ', '.join(error['code'] for error in payload['errors'])
+        )
+        return cls._create_braintree_logs([{
             'transaction': transaction,
-            'log': '\r\n'.join(text),
+            'log': cls._dump_braintree_payload(payload),
             'is_system_generated': True,
         }])
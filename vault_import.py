@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    vault_import.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.config import config
+from trytond.transaction import Transaction
+
+import braintree
+
+__all__ = ['BraintreeVaultImport']
+
+logger = logging.getLogger(__name__)
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+}
+DEPENDS = ['state']
+
+
+class BraintreeVaultImport(ModelSQL, ModelView):
+    "Braintree Vault Import"
+    __name__ = 'payment_gateway.braintree.vault_import'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True,
+        domain=[('provider', '=', 'braintree')],
+        states=STATES, depends=DEPENDS
+    )
+    match_key = fields.Selection([
+        ('email', 'Email'),
+        ('code', 'Party Code'),
+        ('customer_id', 'Known Customer ID'),
+    ], 'Match Customers By', required=True, states=STATES, depends=DEPENDS,
+        help="How Braintree customers are matched to parties: by email, "
+        "by a party code equal to the customer id, or by the customer id "
+        "of an existing payment profile of the party.")
+    start = fields.DateTime(
+        'Customers Created From', required=True,
+        states=STATES, depends=DEPENDS
+    )
+    checkpoint = fields.DateTime(
+        'Checkpoint', readonly=True,
+        help="Customers created before this date have all been imported."
+    )
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
+    customer_count = fields.Integer('Customers', readonly=True)
+    profile_count = fields.Integer('Profiles Created', readonly=True)
+    unmatched_count = fields.Integer('Unmatched Customers', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BraintreeVaultImport, cls).__setup__()
+        cls._buttons.update({
+            'import_vault': {
+                'invisible': Eval('state') != 'draft',
+            },
+        })
+
+    @staticmethod
+    def default_match_key():
+        return 'email'
+
+    @staticmethod
+    def default_start():
+        # Before any Braintree vault
+        return datetime(2007, 1, 1)
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_customer_count():
+        return 0
+
+    @staticmethod
+    def default_profile_count():
+        return 0
+
+    @staticmethod
+    def default_unmatched_count():
+        return 0
+
+    @classmethod
+    @ModelView.button
+    def import_vault(cls, imports):
+        for vault_import in imports:
+            vault_import.import_braintree_vault()
+
+    def import_braintree_vault(self, commit=True):
+        """
+        Create the payment profiles of the cards stored in the Braintree
+        vault for the matching parties.
+
+        Customers are searched one window of `vault_import_window` seconds
+        (from the `braintree` configuration section) of creation date at a
+        time, starting from the checkpoint, and read page by page. The
+        checkpoint is moved to the end of each window once it is done,
+        together with the customer counters of the window.
+
+        Unless `commit` is unset, the database transaction is committed
+        after each chunk of `batch_chunk_size` customers, so an interrupted
+        import resumes from the last checkpoint. Cards which already have a
+        profile are skipped so resuming never creates duplicates, and the
+        customers of the interrupted window are only counted once.
+        """
+        client = self.gateway.get_braintree_client()
+        window = timedelta(seconds=config.getint(
+            'braintree', 'vault_import_window', default=2592000
+        ))
+        now = datetime.utcnow()
+
+        start = self.checkpoint or self.start
+        while start < now:
+            end = min(start + window, now)
+            customer_count, unmatched_count = self._import_braintree_window(
+                client, start, end, end == now, commit
+            )
+            self.customer_count += customer_count
+            self.unmatched_count += unmatched_count
+            self.checkpoint = end
+            self.save()
+            if commit:
+                Transaction().commit()
+            start = end
+
+        self.state = 'done'
+        self.save()
+        logger.info(
+            'Braintree vault import %s: %d customers, %d profiles created, '
+            '%d unmatched', self.id, self.customer_count, self.profile_count,
+            self.unmatched_count
+        )
+
+    def _import_braintree_window(self, client, start, end, last, commit):
+        """
+        Import the customers created from `start` until `end`, which is
+        excluded unless it is the `last` window.
+
+        Return the number of customers and of unmatched customers.
+        """
+        chunk_size = config.getint(
+            'braintree', 'batch_chunk_size', default=500
+        )
+        result = client.customer.search(
+            braintree.CustomerSearch.created_at.between(start, end)
+        )
+
+        customer_count = unmatched_count = 0
+        chunk = []
+        for customer in result.items:
+            if customer.created_at >= end and not last:
+                continue
+            chunk.append(customer)
+            if len(chunk) >= chunk_size:
+                customer_count += len(chunk)
+                unmatched_count += self._import_braintree_customers(chunk)
+                chunk = []
+                if commit:
+                    Transaction().commit()
+        if chunk:
+            customer_count += len(chunk)
+            unmatched_count += self._import_braintree_customers(chunk)
+        return customer_count, unmatched_count
+
+    def _import_braintree_customers(self, customers):
+        """
+        Create in bulk the profiles of the cards of the customers and return
+        the number of customers without a matching party.
+
+        The profile count is saved with the profiles, the customer counters
+        are only saved with the checkpoint of the window.
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        parties = self._match_braintree_customers(customers)
+        tokens = [
+            card.token for customer in customers
+            for card in customer.credit_cards
+        ]
+        existing = set(p.provider_reference for p in PaymentProfile.search([
+            ('gateway', '=', self.gateway.id),
+            ('provider_reference', 'in', tokens),
+        ]))
+
+        unmatched_count = 0
+        vlist = []
+        for customer in customers:
+            party = parties.get(customer.id)
+            if party is None or not party.addresses:
+                unmatched_count += 1
+                continue
+            for card in customer.credit_cards:
+                if card.token in existing:
+                    continue
+                vlist.append({
+                    'name': card.cardholder_name,
+                    'party': party.id,
+                    'address': party.addresses[0].id,
+                    'gateway': self.gateway.id,
+                    'last_4_digits': card.last_4,
+                    'expiry_month': card.expiration_month,
+                    'expiry_year': card.expiration_year,
+                    'provider_reference': card.token,
+                    'braintree_customer_id': customer.id,
+                })
+        if vlist:
+            PaymentProfile.create(vlist)
+
+        self.profile_count += len(vlist)
+        self.save()
+        return unmatched_count
+
+    def _match_braintree_customers(self, customers):
+        """
+        Return the matching party of the customers by customer id
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        PaymentProfile = pool.get('party.payment_profile')
+
+        if self.match_key == 'email':
+            by_email = {}
+            for customer in customers:
+                if customer.email:
+                    by_email.setdefault(customer.email.lower(), customer.id)
+            emails = set(c.email for c in customers if c.email)
+            parties = {}
+            for mechanism in ContactMechanism.search([
+                    ('type', '=', 'email'),
+                    ('value', 'in', list(emails | set(by_email))),
+                    ]):
+                customer_id = by_email.get(mechanism.value.lower())
+                parties.setdefault(customer_id, mechanism.party)
+            return parties
+        elif self.match_key == 'code':
+            return dict((party.code, party) for party in Party.search([
+                ('code', 'in', [customer.id for customer in customers]),
+            ]))
+        return dict(
+            (profile.braintree_customer_id, profile.party)
+            for profile in PaymentProfile.search([
+                ('gateway', '=', self.gateway.id),
+                ('braintree_customer_id', 'in', [c.id for c in customers]),
+            ])
+        )